@@ -39,94 +39,69 @@ def main(
 
     try:
         # ============================================================
-        # STEP 1A: LOOK UP WEBHOOK EVENT
+        # STEP 1A: CLAIM WEBHOOK EVENT
         # ============================================================
-        # The webhook_events record is created by Express (webhook-server)
-        # before triggering Windmill. We just need to look it up here.
-        # This avoids duplicate idempotency checks and race conditions.
-        webhook_lookup = """
-            SELECT id, status, processed_at
-            FROM webhook_events
-            WHERE whatsapp_message_id = %s
-        """
-        cur.execute(webhook_lookup, (message_id,))
-        existing_event = cur.fetchone()
-
-        if existing_event:
-            status = existing_event["status"]
-            webhook_event_id = existing_event["id"]
-
-            # If already completed, skip (idempotency)
-            if status == "completed":
-                print(f"Message already processed: {message_id}")
-                return {
-                    "proceed": False,
-                    "reason": "Already Processed",
-                    "webhook_event_id": webhook_event_id,
-                }
-
-            # NOTE: We do NOT check for 'processing' status here.
-            # Express (webhook-server) handles idempotency via INSERT ... ON CONFLICT.
-            # When we reach this point, Express already set status='processing' and
-            # this is the legitimate Windmill invocation that should process the message.
-
-            # If failed, allow retry - update status to processing
-            if status == "failed":
-                print(f"Retrying failed message: {message_id}")
-                cur.execute(
-                    "UPDATE webhook_events SET status = 'processing' WHERE id = %s",
-                    (webhook_event_id,)
-                )
-                conn.commit()
-        else:
-            # No existing record - Express should have created it
-            # Create one as fallback (for backwards compatibility / manual testing)
-            print(f"Warning: No webhook_events record found for {message_id}, creating one")
-            create_event = """
+        # The webhook_events record is normally created by Express
+        # (webhook-server) before triggering Windmill. A single statement
+        # looks it up, flips 'failed' events back to 'processing' for retry,
+        # and creates the record as a fallback when Express didn't (manual
+        # testing / backwards compatibility). Events that are already
+        # 'processing' or 'completed' are left untouched.
+        claim_event = """
+            WITH existing AS (
+                SELECT id, status
+                FROM webhook_events
+                WHERE whatsapp_message_id = %(message_id)s
+            ),
+            upserted AS (
                 INSERT INTO webhook_events (
                     whatsapp_message_id,
                     phone_number_id,
                     status,
                     received_at
-                ) VALUES (%s, %s, 'processing', NOW())
-                ON CONFLICT (whatsapp_message_id) DO UPDATE SET status = 'processing'
-                RETURNING id
-            """
-            cur.execute(create_event, (message_id, whatsapp_phone_id))
-            webhook_event_id = cur.fetchone()["id"]
-            conn.commit()
+                ) VALUES (%(message_id)s, %(phone_id)s, 'processing', NOW())
+                ON CONFLICT (whatsapp_message_id) DO UPDATE
+                    SET status = 'processing'
+                    WHERE webhook_events.status = 'failed'
+                RETURNING id, status
+            )
+            SELECT
+                COALESCE(u.id, e.id) AS id,
+                COALESCE(u.status, e.status) AS status,
+                e.status AS previous_status
+            FROM (SELECT 1) AS one
+            LEFT JOIN upserted u ON TRUE
+            LEFT JOIN existing e ON TRUE
+        """
+        cur.execute(claim_event, {"message_id": message_id, "phone_id": whatsapp_phone_id})
+        event = cur.fetchone()
+        conn.commit()
+
+        webhook_event_id = event["id"]
+        previous_status = event["previous_status"]
+
+        # If already completed, skip (idempotency)
+        if event["status"] == "completed":
+            print(f"Message already processed: {message_id}")
+            return {
+                "proceed": False,
+                "reason": "Already Processed",
+                "webhook_event_id": webhook_event_id,
+            }
+
+        # NOTE: We do NOT reject 'processing' status here.
+        # Express (webhook-server) handles idempotency via INSERT ... ON CONFLICT.
+        # When we reach this point, Express already set status='processing' and
+        # this is the legitimate Windmill invocation that should process the message.
+        if previous_status == "failed":
+            print(f"Retrying failed message: {message_id}")
+        elif previous_status is None:
+            print(f"Warning: No webhook_events record found for {message_id}, created one")
 
         # ============================================================
         # STEP 1B: FETCH CHATBOT + ORGANIZATION
         # ============================================================
-        bot_query = """
-            SELECT
-                c.id,
-                c.organization_id,
-                c.name,
-                c.system_prompt,
-                c.persona,
-                c.model_name,
-                c.temperature,
-                c.rag_enabled,
-                c.whatsapp_access_token,
-                c.is_active,
-                c.fallback_message_error,
-                c.fallback_message_limit,
-                -- Organization info
-                o.name as org_name,
-                o.plan_tier,
-                o.is_active as org_is_active,
-                o.message_limit_monthly,
-                o.token_limit_monthly,
-                o.billing_period_start,
-                o.billing_period_end
-            FROM chatbots c
-            JOIN organizations o ON c.organization_id = o.id
-            WHERE c.whatsapp_phone_number_id = %s
-        """
-        cur.execute(bot_query, (whatsapp_phone_id,))
-        bot = cur.fetchone()
+        bot = _fetch_chatbot(cur, whatsapp_phone_id)
 
         if not bot:
             print(f"No chatbot found for WhatsApp ID: {whatsapp_phone_id}")
@@ -310,6 +285,36 @@ def main(
             conn.close()
 
 
+def _fetch_chatbot(cur, whatsapp_phone_id: str) -> Optional[Dict[str, Any]]:
+    """Fetch chatbot + organization config for a WhatsApp phone number ID."""
+    bot_query = """
+        SELECT
+            c.id,
+            c.organization_id,
+            c.name,
+            c.system_prompt,
+            c.persona,
+            c.model_name,
+            c.temperature,
+            c.rag_enabled,
+            c.whatsapp_access_token,
+            c.is_active,
+            c.fallback_message_error,
+            c.fallback_message_limit,
+            -- Organization info
+            o.is_active as org_is_active,
+            o.message_limit_monthly,
+            o.token_limit_monthly,
+            o.billing_period_start,
+            o.billing_period_end
+        FROM chatbots c
+        JOIN organizations o ON c.organization_id = o.id
+        WHERE c.whatsapp_phone_number_id = %s
+    """
+    cur.execute(bot_query, (whatsapp_phone_id,))
+    return cur.fetchone()
+
+
 def _check_usage_limits(
     cur,
     org_id: str,
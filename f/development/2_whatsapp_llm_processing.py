@@ -1,5 +1,6 @@
 import wmill
 import os
+import time
 import json
 from openai import OpenAI
 from google import genai
@@ -8,6 +9,14 @@ from typing import Dict, Any, List, Optional, Tuple
 from f.development.utils.db_utils import get_db_connection
 from f.development.utils.flow_utils import estimate_tokens
 
+# retrieve_knowledge results keyed by (chatbot_id, query, db_resource, top_k,
+# similarity_threshold). Saves the embedding call and vector search when the
+# agent loop repeats a search, or a reused worker sees the same question again.
+# Entries expire quickly so knowledge base edits show up.
+RAG_CACHE_TTL_SECONDS = 30
+RAG_CACHE_MAX_ENTRIES = 512
+_rag_cache: Dict[Tuple[str, str, str, int, float], Tuple[float, List[Dict[str, Any]]]] = {}
+
 # =============================================================================
 # MODEL FALLBACK CONFIGURATION
 # =============================================================================
@@ -29,6 +38,28 @@ def is_rate_limit_error(error: Exception) -> bool:
     ])
 
 
+def get_cached_tokens(usage: Any) -> int:
+    """Prompt tokens served from OpenAI's prompt cache (0 when not reported)."""
+    details = getattr(usage, "prompt_tokens_details", None)
+    return getattr(details, "cached_tokens", 0) or 0
+
+
+def to_plain_args(value: Any) -> Any:
+    """
+    Convert Gemini function call args to plain Python values.
+
+    The args may be a protobuf Struct, whose lists and nested objects come
+    back as ListValue/Struct from dict(); those aren't JSON serializable.
+    """
+    if isinstance(value, (str, bytes)):
+        return value
+    if hasattr(value, "keys"):
+        return {key: to_plain_args(value[key]) for key in value.keys()}
+    if hasattr(value, "__len__"):
+        return [to_plain_args(item) for item in value]
+    return value
+
+
 def build_tool_instructions(tools: List[Dict]) -> str:
     """
     Auto-generate tool usage instructions from tool configs.
@@ -366,6 +397,7 @@ def attempt_llm_generation(
                 "model": model_name,
                 "tokens_input": response.usage.prompt_tokens,
                 "tokens_output": response.usage.completion_tokens,
+                "tokens_cached": get_cached_tokens(response.usage),
                 "rag_used": bool(rag_context),
                 "chunks_retrieved": len(retrieved_chunks),
             }
@@ -502,7 +534,12 @@ def retrieve_knowledge(
     if not openai_api_key:
         print("No OpenAI API key provided, skipping RAG")
         return []
-    
+
+    cache_key = (chatbot_id, query, db_resource, top_k, similarity_threshold)
+    cached = _rag_cache.get(cache_key)
+    if cached and time.monotonic() - cached[0] < RAG_CACHE_TTL_SECONDS:
+        return cached[1]
+
     try:
         # 1. Generate embedding for the query
         client = OpenAI(api_key=openai_api_key)
@@ -523,13 +560,26 @@ def retrieve_knowledge(
             )
 
             results = cur.fetchall()
-            return [dict(row) for row in results]
+            chunks = [dict(row) for row in results]
+
+        # Only successful lookups are cached; errors return [] below.
+        # Re-insert refreshed keys so they move to the end of the eviction order.
+        _rag_cache.pop(cache_key, None)
+        if len(_rag_cache) >= RAG_CACHE_MAX_ENTRIES:
+            _rag_cache.pop(next(iter(_rag_cache)))
+        _rag_cache[cache_key] = (time.monotonic(), chunks)
+        return chunks
 
     except Exception as e:
         print(f"RAG retrieval error: {e}")
         return []
 
 
+def _rag_cache_clear():
+    """Drop all cached knowledge base results (e.g. after changing them in tests)."""
+    _rag_cache.clear()
+
+
 def sanitize_gemini_parameters(params: dict) -> dict:
     """
     Clean up JSON Schema parameters for Gemini API compatibility.
@@ -699,6 +749,7 @@ def execute_agent_loop_openai(
     tool_executions = []
     total_tokens_input = 0
     total_tokens_output = 0
+    total_tokens_cached = 0
 
     while iteration < max_iterations:
         iteration += 1
@@ -717,6 +768,7 @@ def execute_agent_loop_openai(
             # Track token usage
             total_tokens_input += response.usage.prompt_tokens
             total_tokens_output += response.usage.completion_tokens
+            total_tokens_cached += get_cached_tokens(response.usage)
 
             choice = response.choices[0]
             finish_reason = choice.finish_reason
@@ -780,6 +832,7 @@ def execute_agent_loop_openai(
                         "model": model_name,
                         "tokens_input": total_tokens_input,
                         "tokens_output": total_tokens_output,
+                        "tokens_cached": total_tokens_cached,
                         "tool_calls": len(tool_executions),
                         "iterations": iteration
                     }
@@ -798,6 +851,7 @@ def execute_agent_loop_openai(
                         "model": model_name,
                         "tokens_input": total_tokens_input,
                         "tokens_output": total_tokens_output,
+                        "tokens_cached": total_tokens_cached,
                         "tool_calls": len(tool_executions),
                         "iterations": iteration,
                         "finish_reason": finish_reason
@@ -814,6 +868,7 @@ def execute_agent_loop_openai(
                     "model": model_name,
                     "tokens_input": total_tokens_input,
                     "tokens_output": total_tokens_output,
+                    "tokens_cached": total_tokens_cached,
                     "tool_calls": len(tool_executions),
                     "iterations": iteration,
                     "error": str(e)
@@ -830,6 +885,7 @@ def execute_agent_loop_openai(
             "model": model_name,
             "tokens_input": total_tokens_input,
             "tokens_output": total_tokens_output,
+            "tokens_cached": total_tokens_cached,
             "tool_calls": len(tool_executions),
             "iterations": iteration,
             "max_iterations_reached": True
@@ -947,7 +1003,7 @@ def execute_agent_loop_gemini(
                     tool_args = {}
                     if hasattr(fc, 'args') and fc.args:
                         # fc.args is a dict-like object in new SDK
-                        tool_args = dict(fc.args)
+                        tool_args = to_plain_args(fc.args)
 
                     print(f"Executing tool: {tool_name} with args: {tool_args}")
 
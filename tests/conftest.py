@@ -12,15 +12,23 @@ import os
 import sys
 import pytest
 import psycopg2
+from psycopg2 import sql
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
 from psycopg2.extras import RealDictCursor
-from typing import Dict, Any, Generator
+from typing import Dict, Any, Generator, Set
 from pathlib import Path
-from unittest.mock import Mock, patch
+from types import SimpleNamespace
+from unittest.mock import Mock, MagicMock, patch
 
 # Add project root to path
 PROJECT_ROOT = Path(__file__).parent.parent
 sys.path.insert(0, str(PROJECT_ROOT))
 
+# pytest-xdist worker id ("gw0", "gw1", ...), None when running serially.
+# Each worker gets its own schema so parallel resets don't collide.
+XDIST_WORKER = os.getenv("PYTEST_XDIST_WORKER")
+TEST_DB_SCHEMA = f"test_{XDIST_WORKER}" if XDIST_WORKER else None
+
 # Import test harness modules
 from tests.test_harness.windmill_mock import WindmillMock
 from tests.test_harness.llm_mock import LLMMock
@@ -85,14 +93,53 @@ def set_test_env_vars(test_env_vars):
 # ============================================================================
 
 @pytest.fixture(scope="session")
-def db_connection(test_db_config):
+def db_worker_schema():
+    """
+    Set libpq session options for every connection made by the tests.
+
+    PGOPTIONS is read by libpq for every connection in the process, so the
+    scripts under test (which open their own connections) pick it up too:
+    - synchronous_commit=off: commits don't wait for the WAL flush. Test
+      data is disposable, and db_with_autocommit / the scripts commit a lot.
+    - Under pytest-xdist, the worker schema goes first on the search_path.
+      Extensions stay in public.
+
+    Returns the worker schema name, or None when running serially.
+    """
+    options = ["-c synchronous_commit=off"]
+    if TEST_DB_SCHEMA:
+        options.append(f"-c search_path={TEST_DB_SCHEMA},public")
+
+    original = os.environ.get("PGOPTIONS")
+    os.environ["PGOPTIONS"] = " ".join(filter(None, [original, *options]))
+
+    yield TEST_DB_SCHEMA
+
+    if original is None:
+        os.environ.pop("PGOPTIONS", None)
+    else:
+        os.environ["PGOPTIONS"] = original
+
+
+@pytest.fixture(scope="session")
+def db_connection(test_db_config, db_worker_schema):
     """
     Create a database connection for the entire test session.
     This connection is used to reset the database between tests.
     """
     conn = psycopg2.connect(**test_db_config)
     conn.autocommit = True
+
+    if db_worker_schema:
+        with conn.cursor() as cursor:
+            cursor.execute(f"CREATE SCHEMA IF NOT EXISTS {db_worker_schema}")
+
     yield conn
+
+    if db_worker_schema:
+        with conn.cursor() as cursor:
+            cursor.execute(f"DROP SCHEMA IF EXISTS {db_worker_schema} CASCADE")
+
     conn.close()
 
 
@@ -114,47 +161,110 @@ def db_cursor(db_connection):
     db_connection.autocommit = True
 
 
-@pytest.fixture(scope="function")
-def clean_db(db_connection, test_env_vars):
+def _reset_database(connection, env_vars: Dict[str, str], seed_state: Dict[str, bool]) -> None:
     """
-    Reset database to a clean state before each test.
-    Runs the drop, create, and seed SQL scripts.
+    Reset the test schema to the seed data from the db/ SQL scripts.
+
+    The first reset of the session drops and recreates the schema. Later
+    resets only TRUNCATE the tables and replay seed.sql, skipping the DDL.
     """
-    cursor = db_connection.cursor()
-    
+    cursor = connection.cursor()
+
     # Read and execute SQL files
     sql_dir = PROJECT_ROOT / "db"
-    
-    # Drop tables
-    with open(sql_dir / "drop.sql") as f:
-        cursor.execute(f.read())
-    
-    # Create schema
-    with open(sql_dir / "create.sql") as f:
-        cursor.execute(f.read())
-    
+
+    if seed_state.get("schema_created"):
+        # Empty every table in the current schema
+        cursor.execute("SELECT tablename FROM pg_tables WHERE schemaname = current_schema()")
+        tables = [sql.Identifier(row[0]) for row in cursor.fetchall()]
+        if tables:
+            cursor.execute(
+                sql.SQL("TRUNCATE {} RESTART IDENTITY CASCADE").format(sql.SQL(", ").join(tables))
+            )
+    else:
+        # Drop tables
+        with open(sql_dir / "drop.sql") as f:
+            cursor.execute(f.read())
+
+        # Create schema
+        with open(sql_dir / "create.sql") as f:
+            cursor.execute(f.read())
+
+        seed_state["schema_created"] = True
+
     # Seed data (with environment variable substitution)
     with open(sql_dir / "seed.sql") as f:
         seed_sql = f.read()
         # Replace environment variables
-        for key, value in test_env_vars.items():
+        for key, value in env_vars.items():
             seed_sql = seed_sql.replace(f"${{{key}}}", value)
         cursor.execute(seed_sql)
-    
+
     cursor.close()
-    
+
+
+@pytest.fixture(scope="session")
+def db_seed_state() -> Dict[str, bool]:
+    """
+    Track whether the seeded schema may contain committed test changes,
+    and whether the schema has been created in this session.
+
+    Starts dirty so the first database test always seeds.
+    """
+    return {"dirty": True, "schema_created": False}
+
+
+@pytest.fixture(scope="function")
+def clean_db(db_connection, test_env_vars, db_seed_state):
+    """
+    Reset database to a clean state before each test.
+    Truncates and reseeds the tables (full DDL only on the first reset).
+    """
+    _reset_database(db_connection, test_env_vars, db_seed_state)
+
     yield  # Test runs here
-    
-    # No cleanup needed - next test will reset
+
+    # Tests using clean_db may commit (e.g. via db_with_autocommit),
+    # so the next db_with_data test has to reseed
+    db_seed_state["dirty"] = True
+
+
+@pytest.fixture(scope="function")
+def seeded_db(db_connection, test_env_vars, db_seed_state):
+    """
+    Ensure the seed data is loaded, reseeding only when a previous test
+    may have committed changes.
+    """
+    if db_seed_state["dirty"]:
+        _reset_database(db_connection, test_env_vars, db_seed_state)
+        db_seed_state["dirty"] = False
 
 
 @pytest.fixture
-def db_with_data(clean_db, db_cursor):
+def db_with_data(monkeypatch, seeded_db, db_cursor, db_seed_state):
     """
     Provides a database with seed data and a cursor for queries.
     This is the most commonly used database fixture.
+
+    The seed is loaded once and shared; each test runs inside a transaction
+    that db_cursor rolls back afterwards, so changes never leak between tests.
+    Code that opens its own connection (e.g. a step script) can commit
+    outside that transaction, so any psycopg2.connect() during the test
+    marks the seed dirty. Such tests should use db_with_autocommit instead.
     """
-    return db_cursor
+    real_connect = psycopg2.connect
+
+    def connect_and_mark_dirty(*args, **kwargs):
+        db_seed_state["dirty"] = True
+        return real_connect(*args, **kwargs)
+
+    monkeypatch.setattr(psycopg2, "connect", connect_and_mark_dirty)
+
+    yield db_cursor
+
+    if db_cursor.connection.info.transaction_status == TRANSACTION_STATUS_IDLE:
+        # The test committed, so the seed is dirty
+        db_seed_state["dirty"] = True
 
 
 @pytest.fixture
@@ -196,6 +306,22 @@ def mock_whatsapp():
     return WhatsAppMock()
 
 
+@pytest.fixture
+def mock_db():
+    """
+    Mock psycopg2 connection for pure-logic tests that don't need PostgreSQL.
+
+    Queue query results on mock_db.cursor.fetchone / fetchall (return_value
+    or side_effect). Any psycopg2.connect() call returns mock_db.connection.
+    """
+    mock_conn = MagicMock()
+    mock_cursor = MagicMock()
+    mock_conn.cursor.return_value = mock_cursor
+
+    with patch('psycopg2.connect', return_value=mock_conn) as mock_connect:
+        yield SimpleNamespace(connect=mock_connect, connection=mock_conn, cursor=mock_cursor)
+
+
 @pytest.fixture
 def mock_all_external(mock_wmill, mock_llm, mock_whatsapp):
     """
@@ -414,47 +540,65 @@ def assert_db_state():
     return _assert
 
 
+@pytest.fixture(scope="session")
+def prepared_statements(db_connection) -> Set[str]:
+    """
+    Names of the query_helper statements already prepared on the session
+    connection, so each one is prepared once without asking the server.
+    """
+    return set()
+
+
 @pytest.fixture
-def query_helper(db_cursor):
+def query_helper(db_cursor, prepared_statements):
     """Helper fixture for common database queries."""
     class QueryHelper:
-        def __init__(self, cursor):
+        # Server-side prepared statements, created lazily once per connection
+        PREPARED_QUERIES = {
+            "qh_get_organization": "SELECT * FROM organizations WHERE id = $1",
+            "qh_get_chatbot": "SELECT * FROM chatbots WHERE id = $1",
+            "qh_get_contact": "SELECT * FROM contacts WHERE id = $1",
+            "qh_get_messages": "SELECT * FROM messages WHERE contact_id = $1 ORDER BY created_at",
+            "qh_get_usage_logs": "SELECT * FROM usage_logs WHERE organization_id = $1 ORDER BY created_at",
+            "qh_get_webhook_event": "SELECT * FROM webhook_events WHERE whatsapp_message_id = $1",
+        }
+
+        def __init__(self, cursor, prepared: Set[str]):
             self.cursor = cursor
-        
+            self._prepared = prepared
+
+        def _execute(self, name: str, param):
+            if name not in self._prepared:
+                self.cursor.execute(f"PREPARE {name} AS {self.PREPARED_QUERIES[name]}")
+                self._prepared.add(name)
+
+            self.cursor.execute(f"EXECUTE {name} (%s)", (param,))
+
         def get_organization(self, org_id: str) -> Dict:
-            self.cursor.execute("SELECT * FROM organizations WHERE id = %s", (org_id,))
+            self._execute("qh_get_organization", org_id)
             return self.cursor.fetchone()
-        
+
         def get_chatbot(self, chatbot_id: str) -> Dict:
-            self.cursor.execute("SELECT * FROM chatbots WHERE id = %s", (chatbot_id,))
+            self._execute("qh_get_chatbot", chatbot_id)
             return self.cursor.fetchone()
-        
+
         def get_contact(self, contact_id: str) -> Dict:
-            self.cursor.execute("SELECT * FROM contacts WHERE id = %s", (contact_id,))
+            self._execute("qh_get_contact", contact_id)
             return self.cursor.fetchone()
-        
+
         def get_messages(self, contact_id: str) -> list:
-            self.cursor.execute(
-                "SELECT * FROM messages WHERE contact_id = %s ORDER BY created_at",
-                (contact_id,)
-            )
+            self._execute("qh_get_messages", contact_id)
             return self.cursor.fetchall()
-        
+
         def get_usage_logs(self, org_id: str) -> list:
-            self.cursor.execute(
-                "SELECT * FROM usage_logs WHERE organization_id = %s ORDER BY created_at",
-                (org_id,)
-            )
+            self._execute("qh_get_usage_logs", org_id)
             return self.cursor.fetchall()
-        
+
         def get_webhook_event(self, message_id: str) -> Dict:
-            self.cursor.execute(
-                "SELECT * FROM webhook_events WHERE whatsapp_message_id = %s",
-                (message_id,)
-            )
+            self._execute("qh_get_webhook_event", message_id)
             return self.cursor.fetchone()
-    
-    return QueryHelper(db_cursor)
+
+    return QueryHelper(db_cursor, prepared_statements)
 
 
 # ============================================================================
@@ -481,6 +625,20 @@ def pytest_collection_modifyitems(config, items):
         if "integration" in str(item.fspath):
             item.add_marker(pytest.mark.integration)
 
+    # Run modules with database or slow tests last so -x / --lf feedback
+    # from the mocked tests comes first. Whole modules move together so
+    # module-scoped fixtures are only set up once (stable sort keeps file
+    # order otherwise).
+    module_of = {item: item.nodeid.split("::")[0] for item in items}
+    heavy_modules = {
+        module_of[item] for item in items
+        if item.get_closest_marker("db") or item.get_closest_marker("slow")
+    }
+    module_order = {}
+    for item in items:
+        module_order.setdefault(module_of[item], len(module_order))
+    items.sort(key=lambda item: (module_of[item] in heavy_modules, module_order[module_of[item]]))
+
 
 # ============================================================================
 # EMBEDDING FIXTURES
@@ -16,6 +16,9 @@ import psycopg2
 from datetime import datetime, timedelta
 from decimal import Decimal
 
+# 1536-dimension pgvector literals, built once and reused by the RAG tests
+EMBEDDING_01 = '[' + ', '.join(['0.1'] * 1536) + ']'
+EMBEDDING_02 = '[' + ', '.join(['0.2'] * 1536) + ']'
 
 # ============================================================================
 # 1. CRUD TESTS FOR CORE TABLES
@@ -507,7 +510,7 @@ class TestDocumentChunksCRUD:
         source_id = db_with_data.fetchone()['id']
 
         # Create embedding vector (1536 dimensions)
-        embedding = '[' + ', '.join(['0.1'] * 1536) + ']'
+        embedding = EMBEDDING_01
 
         # Insert chunk
         db_with_data.execute("""
@@ -948,7 +951,7 @@ class TestSearchKnowledgeBaseFunction:
         source_id = db_with_autocommit.fetchone()['id']
 
         # Create similar embedding (1536 dimensions, all 0.1)
-        similar_embedding = '[' + ', '.join(['0.1'] * 1536) + ']'
+        similar_embedding = EMBEDDING_01
 
         # Insert chunks with embeddings
         db_with_autocommit.execute("""
@@ -965,7 +968,7 @@ class TestSearchKnowledgeBaseFunction:
               similar_embedding, '{"page": 1}'))
 
         # Call search function
-        query_embedding = '[' + ', '.join(['0.1'] * 1536) + ']'
+        query_embedding = EMBEDDING_01
 
         db_with_autocommit.execute("""
             SELECT * FROM search_knowledge_base(
@@ -1022,7 +1025,7 @@ class TestSearchKnowledgeBaseFunction:
             source_id = db_with_autocommit.fetchone()['id']
 
             # Insert chunk
-            embedding = '[' + ', '.join(['0.1'] * 1536) + ']'
+            embedding = EMBEDDING_01
             db_with_autocommit.execute("""
                 INSERT INTO document_chunks (
                     knowledge_source_id,
@@ -1035,7 +1038,7 @@ class TestSearchKnowledgeBaseFunction:
             """, (source_id, chatbot_id, f'Content for {name}', 0, embedding))
 
         # Search for chatbot 1 only
-        query_embedding = '[' + ', '.join(['0.1'] * 1536) + ']'
+        query_embedding = EMBEDDING_01
 
         db_with_autocommit.execute("""
             SELECT * FROM search_knowledge_base(
@@ -1076,7 +1079,7 @@ class TestSearchKnowledgeBaseFunction:
         source_id = db_with_autocommit.fetchone()['id']
 
         # Insert 10 chunks
-        embedding = '[' + ', '.join(['0.1'] * 1536) + ']'
+        embedding = EMBEDDING_01
         for i in range(10):
             db_with_autocommit.execute("""
                 INSERT INTO document_chunks (
@@ -1090,7 +1093,7 @@ class TestSearchKnowledgeBaseFunction:
             """, (source_id, chatbot_id, f'Chunk {i}', i, embedding))
 
         # Search with limit=3
-        query_embedding = '[' + ', '.join(['0.1'] * 1536) + ']'
+        query_embedding = EMBEDDING_01
 
         db_with_autocommit.execute("""
             SELECT * FROM search_knowledge_base(
@@ -1128,7 +1131,7 @@ class TestSearchKnowledgeBaseFunction:
         source_id = db_with_autocommit.fetchone()['id']
 
         # Insert chunk with metadata
-        embedding = '[' + ', '.join(['0.2'] * 1536) + ']'
+        embedding = EMBEDDING_02
         db_with_autocommit.execute("""
             INSERT INTO document_chunks (
                 knowledge_source_id,
@@ -1143,7 +1146,7 @@ class TestSearchKnowledgeBaseFunction:
               embedding, '{"page": 5, "section": "Introduction"}'))
 
         # Search
-        query_embedding = '[' + ', '.join(['0.2'] * 1536) + ']'
+        query_embedding = EMBEDDING_02
 
         db_with_autocommit.execute("""
             SELECT * FROM search_knowledge_base(
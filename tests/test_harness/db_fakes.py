@@ -0,0 +1,65 @@
+"""
+Lightweight psycopg2 stand-ins for pure-logic tests.
+
+FakeConnection / FakeCursor replay queued query results without recording
+calls, so they are much cheaper than MagicMock when a script runs many
+queries per test. Use MagicMock instead when a test asserts on the SQL
+that was executed.
+"""
+
+from typing import Any, Iterable, List
+
+
+class FakeCursor:
+    """Cursor that returns queued rows from fetchone() / fetchall() in order."""
+
+    __slots__ = ("_fetchone_rows", "_fetchall_rows", "_fetchone_index", "_fetchall_index")
+
+    def __init__(self, fetchone_rows: Iterable[Any] = (), fetchall_rows: Iterable[List[Any]] = ()):
+        self._fetchone_rows = list(fetchone_rows)
+        self._fetchall_rows = list(fetchall_rows)
+        self._fetchone_index = 0
+        self._fetchall_index = 0
+
+    def execute(self, query: Any, params: Any = None) -> None:
+        pass
+
+    def fetchone(self) -> Any:
+        row = self._fetchone_rows[self._fetchone_index]
+        self._fetchone_index += 1
+        return row
+
+    def fetchall(self) -> List[Any]:
+        rows = self._fetchall_rows[self._fetchall_index]
+        self._fetchall_index += 1
+        return rows
+
+    def close(self) -> None:
+        pass
+
+    def __enter__(self) -> "FakeCursor":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        pass
+
+
+class FakeConnection:
+    """Connection whose cursor() always returns the same FakeCursor."""
+
+    __slots__ = ("fake_cursor",)
+
+    def __init__(self, fake_cursor: FakeCursor):
+        self.fake_cursor = fake_cursor
+
+    def cursor(self, *args, **kwargs) -> FakeCursor:
+        return self.fake_cursor
+
+    def commit(self) -> None:
+        pass
+
+    def rollback(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
@@ -100,6 +100,7 @@ class LLMMock:
             mock_usage.prompt_tokens = response.tokens_input
             mock_usage.completion_tokens = response.tokens_output
             mock_usage.total_tokens = response.tokens_input + response.tokens_output
+            mock_usage.prompt_tokens_details = None  # No prompt cache hits
             mock_response.usage = mock_usage
             
             return mock_response
@@ -0,0 +1,151 @@
+"""
+Shared fixtures for the unit tests of the Windmill step scripts.
+
+The step scripts can't be imported by name (their file names start with a
+number), so they are loaded from their paths with importlib. Each step is
+loaded once per session. wmill and the Google GenAI SDK are replaced by
+shared mocks for the whole directory.
+"""
+
+import sys
+import importlib.util
+from pathlib import Path
+from types import ModuleType, SimpleNamespace
+from unittest.mock import Mock
+
+import pytest
+import requests
+
+STEPS_DIR = Path(__file__).parent.parent.parent / "f" / "development"
+
+# One wmill mock for every unit test module. It is installed when this
+# conftest is imported, i.e. before any test module in this directory.
+mock_wmill = Mock()
+mock_wmill.get_resource.return_value = {
+    "host": "localhost",
+    "port": 5432,
+    "user": "test_user",
+    "password": "test_password",
+    "dbname": "test_db"
+}
+mock_wmill.get_variable.return_value = "fake_google_api_key"
+
+# Google GenAI SDK
+mock_genai = Mock()
+mock_genai_types = Mock()
+
+
+def _install_mocks() -> None:
+    sys.modules['wmill'] = mock_wmill
+    sys.modules['google.genai'] = mock_genai
+    sys.modules['google.genai.types'] = mock_genai_types
+
+
+_install_mocks()
+
+
+def _load_step(module_name: str, file_name: str) -> ModuleType:
+    """Execute a step script and register it in sys.modules."""
+    # Other test directories may have swapped in their own mocks since
+    # collection, so point the imports back at ours first
+    _install_mocks()
+
+    spec = importlib.util.spec_from_file_location(module_name, STEPS_DIR / file_name)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    sys.modules[module_name] = module
+    return module
+
+
+@pytest.fixture(scope="session")
+def step1_module() -> ModuleType:
+    """Step 1 (context loading) module."""
+    return _load_step("step1", "1_whatsapp_context_loading.py")
+
+
+@pytest.fixture(scope="session")
+def step1_main(step1_module):
+    """Step 1 entry point."""
+    return step1_module.main
+
+
+@pytest.fixture(scope="session")
+def step2_module() -> ModuleType:
+    """
+    Step 2 (LLM processing) module.
+
+    Tests patch the mocks through the module's own bindings
+    (step2_module.wmill, step2_module.genai).
+    """
+    return _load_step("step2", "2_whatsapp_llm_processing.py")
+
+
+@pytest.fixture(scope="session")
+def step2_main(step2_module):
+    """Step 2 entry point."""
+    return step2_module.main
+
+
+@pytest.fixture(scope="session")
+def step3_1_main():
+    """Step 3.1 (send reply to WhatsApp) entry point."""
+    return _load_step("step3_1", "3_1_send_reply_to_whatsapp.py").main
+
+
+@pytest.fixture(scope="session")
+def step4_main():
+    """Step 3.2 (save chat history, 4_save_chat_history.py) entry point."""
+    return _load_step("step4", "4_save_chat_history.py").main
+
+
+@pytest.fixture(scope="session")
+def step5_module() -> ModuleType:
+    """Step 3.3 (usage logging, 5_log_usage.py) module."""
+    return _load_step("step5", "5_log_usage.py")
+
+
+@pytest.fixture(scope="session")
+def step5_main(step5_module):
+    """Step 3.3 entry point."""
+    return step5_module.main
+
+
+@pytest.fixture
+def gemini_client(monkeypatch, step2_module):
+    """Gemini client returned by genai.Client(); set models.generate_content per test."""
+    client = SimpleNamespace(models=SimpleNamespace(generate_content=Mock()))
+    monkeypatch.setattr(step2_module.genai, 'Client', lambda *args, **kwargs: client)
+    return client
+
+
+@pytest.fixture
+def openai_client(monkeypatch, step2_module):
+    """OpenAI client returned by OpenAI(); set chat.completions.create per test."""
+    client = SimpleNamespace(
+        chat=SimpleNamespace(completions=SimpleNamespace(create=Mock())),
+        embeddings=SimpleNamespace(create=Mock()),
+    )
+    monkeypatch.setattr(step2_module, 'OpenAI', lambda *args, **kwargs: client)
+    return client
+
+
+@pytest.fixture
+def http_stub(monkeypatch):
+    """
+    requests.post stand-in for MCP calls.
+
+    Set json_body to the server's reply; calls collects (url, kwargs) per request.
+    """
+    stub = SimpleNamespace(json_body={"result": "success"}, calls=[])
+
+    def post(url, **kwargs):
+        stub.calls.append((url, kwargs))
+        return SimpleNamespace(
+            ok=True,
+            status_code=200,
+            raise_for_status=lambda: None,
+            json=lambda: stub.json_body
+        )
+
+    monkeypatch.setattr(requests, 'post', post)
+    return stub
@@ -5,21 +5,12 @@ Tests the check_knowledge_quota.py utility with all quota limit scenarios.
 """
 
 import pytest
-from unittest.mock import Mock, patch, MagicMock
-import sys
+from unittest.mock import patch
 import importlib.util
 from pathlib import Path
 from contextlib import contextmanager
 
-# ============================================================================
-# MOCK WMILL MODULE BEFORE IMPORTING MODULE UNDER TEST
-# ============================================================================
-
-# Create a mock wmill module
-mock_wmill = Mock()
-sys.modules['wmill'] = mock_wmill
-
-# Now dynamically import the module under test
+# Dynamically import the module under test (wmill is mocked in conftest.py)
 MODULE_PATH = Path(__file__).parent.parent.parent / "f" / "development" / "utils" / "check_knowledge_quota.py"
 spec = importlib.util.spec_from_file_location("check_knowledge_quota", MODULE_PATH)
 check_knowledge_quota_module = importlib.util.module_from_spec(spec)
@@ -254,18 +245,17 @@ class TestQuotaEnforcement:
         assert result["max"] == quota_data["max_daily_ingestions"]
         assert result["remaining"] == 0
 
-    def test_chatbot_not_found(self, mock_db_resource):
+    def test_chatbot_not_found(self, mock_db):
         """Test error handling for non-existent chatbot."""
-        # Execute: Mock get_db_connection and call check_quota
-        with patch.object(check_knowledge_quota_module, 'get_db_connection',
-                          create_mock_db_connection(mock_db_resource)):
-
-            result = check_quota(
-                chatbot_id="00000000-0000-0000-0000-000000000000",
-                source_type="pdf",
-                file_size_mb=1.0,
-                db_resource="test_resource"
-            )
+        # Setup: quota lookup finds no chatbot - no real database needed
+        mock_db.cursor.fetchone.return_value = None
+
+        result = check_quota(
+            chatbot_id="00000000-0000-0000-0000-000000000000",
+            source_type="pdf",
+            file_size_mb=1.0,
+            db_resource="test_resource"
+        )
 
         # Assert: Should return not found error
         assert result["allowed"] is False
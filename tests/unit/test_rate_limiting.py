@@ -4,19 +4,29 @@ Unit tests for rate limiting functionality.
 Tests the Redis-based rate limiter in webhook-server/rateLimiter.js
 using mocked Redis to avoid consuming actual API quota.
 
-IMPORTANT: These tests use mocks to simulate 25 messages without consuming
+IMPORTANT: These tests use fakeredis to simulate 25 messages without consuming
 the Gemini API free tier quota.
 """
 
+import fakeredis
 import pytest
-from unittest.mock import Mock, patch, MagicMock, AsyncMock
-import sys
-from pathlib import Path
 import time
+from types import MappingProxyType
+from typing import Any, Dict, Mapping, Optional
 
 # Note: These are Python tests testing Node.js functionality via mocking
 # We're testing the logic, not the actual implementation
 
+# Rate limits per plan tier (mirrors RATE_LIMITS in rateLimiter.js)
+RATE_LIMITS = MappingProxyType({
+    "free": 20,
+    "pro": 100,
+    "enterprise": 500
+})
+
+# Redis key prefix for per-chatbot sliding windows (`ratelimit:${phoneNumberId}`)
+RATE_LIMIT_KEY_PREFIX = b"ratelimit:"
+
 
 @pytest.mark.unit
 class TestRateLimiting:
@@ -25,108 +35,21 @@ class TestRateLimiting:
     @pytest.fixture
     def rate_limits(self):
         """Rate limits per plan tier."""
-        return {
-            "free": 20,
-            "pro": 100,
-            "enterprise": 500
-        }
+        return RATE_LIMITS
 
     @pytest.fixture
     def mock_redis_client(self):
-        """Mock Redis client with sliding window functionality."""
-        class MockRedisClient:
-            def __init__(self):
-                self.data = {}  # Sorted sets: {key: [(score, value), ...]}
-                self.is_open = True
-                self.expirations = {}
-
-            def zRemRangeByScore(self, key, min_score, max_score):
-                """Remove entries outside time window."""
-                if key in self.data:
-                    self.data[key] = [
-                        (score, value) for score, value in self.data[key]
-                        if not (min_score <= score <= max_score)
-                    ]
-
-            def zCard(self, key):
-                """Count entries in sorted set."""
-                return len(self.data.get(key, []))
-
-            def zAdd(self, key, items):
-                """Add entry to sorted set."""
-                if key not in self.data:
-                    self.data[key] = []
-
-                # items is like [{"score": timestamp, "value": timestamp_str}]
-                if isinstance(items, dict):
-                    self.data[key].append((items["score"], items["value"]))
-                elif isinstance(items, list):
-                    for item in items:
-                        self.data[key].append((item["score"], item["value"]))
-
-                # Sort by score
-                self.data[key].sort(key=lambda x: x[0])
-
-            def expire(self, key, seconds):
-                """Set expiration on key."""
-                self.expirations[key] = seconds
-
-            def zRange(self, key, start, end, options=None):
-                """Get range of entries."""
-                if key not in self.data:
-                    return []
-
-                entries = self.data[key]
-                result = entries[start:end+1] if end >= 0 else entries[start:]
-
-                # Return just values
-                return [value for score, value in result]
-
-            def multi(self):
-                """Start transaction."""
-                return MockRedisMulti(self)
-
-        class MockRedisMulti:
-            def __init__(self, client):
-                self.client = client
-                self.commands = []
-
-            def zRemRangeByScore(self, key, min_score, max_score):
-                self.commands.append(("zRemRangeByScore", key, min_score, max_score))
-                return self
-
-            def zCard(self, key):
-                self.commands.append(("zCard", key))
-                return self
-
-            def zAdd(self, key, items):
-                self.commands.append(("zAdd", key, items))
-                return self
-
-            def expire(self, key, seconds):
-                self.commands.append(("expire", key, seconds))
-                return self
-
-            async def exec(self):
-                """Execute transaction."""
-                results = []
-                for cmd in self.commands:
-                    if cmd[0] == "zRemRangeByScore":
-                        self.client.zRemRangeByScore(cmd[1], cmd[2], cmd[3])
-                        results.append(None)
-                    elif cmd[0] == "zCard":
-                        results.append(self.client.zCard(cmd[1]))
-                    elif cmd[0] == "zAdd":
-                        self.client.zAdd(cmd[1], cmd[2])
-                        results.append(None)
-                    elif cmd[0] == "expire":
-                        self.client.expire(cmd[1], cmd[2])
-                        results.append(None)
-                return results
-
-        return MockRedisClient()
-
-    def simulate_rate_limit_check(self, redis_client, phone_number_id, plan_tier, rate_limits, current_time=None):
+        """In-memory Redis (fakeredis) with real sorted-set semantics."""
+        return fakeredis.FakeStrictRedis()
+
+    def simulate_rate_limit_check(
+        self,
+        redis_client,
+        phone_number_id: str,
+        plan_tier: str,
+        rate_limits: Mapping[str, int],
+        current_time: Optional[int] = None
+    ) -> Dict[str, Any]:
         """
         Simulate the checkRateLimit logic from rateLimiter.js
 
@@ -134,32 +57,27 @@ class TestRateLimiting:
         for testing purposes.
         """
         if current_time is None:
-            current_time = int(time.time() * 1000)  # milliseconds
+            current_time = time.time_ns() // 1_000_000  # milliseconds
 
-        max_requests = rate_limits.get(plan_tier, rate_limits["free"])
-        window_seconds = 3600  # 1 hour
-        key = f"ratelimit:{phone_number_id}"
+        max_requests: int = rate_limits.get(plan_tier, rate_limits["free"])
+        window_seconds: int = 3600  # 1 hour
+        key: bytes = RATE_LIMIT_KEY_PREFIX + phone_number_id.encode()
 
         window_start = current_time - (window_seconds * 1000)
 
-        # Remove old entries
-        redis_client.zRemRangeByScore(key, 0, window_start)
-
-        # Count current requests
-        current_count = redis_client.zCard(key)
-
-        # Add current request
-        redis_client.zAdd(key, {"score": current_time, "value": str(current_time)})
-
-        # Set expiry
-        redis_client.expire(key, window_seconds)
+        # Remove old entries and count current requests atomically
+        pipe = redis_client.pipeline()
+        pipe.zremrangebyscore(key, 0, window_start)
+        pipe.zcard(key)
+        _, current_count = pipe.execute()
 
         if current_count >= max_requests:
-            # Rate limit exceeded
-            oldest_request = redis_client.zRange(key, 0, 0)
+            # Rate limit exceeded - rejected requests are not recorded
+            oldest_request = redis_client.zrange(key, 0, 0, withscores=True)
             reset_in = window_seconds
             if oldest_request:
-                reset_in = max(0, int((int(oldest_request[0]) + (window_seconds * 1000) - current_time) / 1000))
+                _, oldest_score = oldest_request[0]
+                reset_in = max(0, int((oldest_score + (window_seconds * 1000) - current_time) / 1000))
 
             return {
                 "allowed": False,
@@ -168,6 +86,12 @@ class TestRateLimiting:
                 "resetIn": reset_in
             }
 
+        # Add current request
+        redis_client.zadd(key, {str(current_time): current_time})
+
+        # Set expiry
+        redis_client.expire(key, window_seconds)
+
         return {
             "allowed": True,
             "current": current_count + 1,
@@ -179,7 +103,7 @@ class TestRateLimiting:
         """Test that free tier allows exactly 20 messages per hour."""
         phone_number_id = "test_phone_free_tier"
         plan_tier = "free"
-        current_time = int(time.time() * 1000)
+        current_time = time.time_ns() // 1_000_000
 
         # Send 20 messages (should all be allowed)
         for i in range(20):
@@ -214,7 +138,7 @@ class TestRateLimiting:
         """
         phone_number_id = "test_phone_spam_attempt"
         plan_tier = "free"
-        current_time = int(time.time() * 1000)
+        current_time = time.time_ns() // 1_000_000
 
         allowed_count = 0
         blocked_count = 0
@@ -242,18 +166,20 @@ class TestRateLimiting:
         """Test that pro tier allows 100 messages per hour."""
         phone_number_id = "test_phone_pro_tier"
         plan_tier = "pro"
-        current_time = int(time.time() * 1000)
+        current_time = time.time_ns() // 1_000_000
 
         # Send 100 messages (should all be allowed)
-        for i in range(100):
-            result = self.simulate_rate_limit_check(
+        allowed = [
+            self.simulate_rate_limit_check(
                 mock_redis_client,
                 phone_number_id,
                 plan_tier,
                 rate_limits,
                 current_time + (i * 100)
-            )
-            assert result["allowed"] is True, f"Message {i+1} should be allowed"
+            )["allowed"]
+            for i in range(100)
+        ]
+        assert all(allowed), f"Message {allowed.index(False) + 1} should be allowed"
 
         # 101st message should be blocked
         result = self.simulate_rate_limit_check(
@@ -271,18 +197,20 @@ class TestRateLimiting:
         """Test that enterprise tier allows 500 messages per hour."""
         phone_number_id = "test_phone_enterprise"
         plan_tier = "enterprise"
-        current_time = int(time.time() * 1000)
+        current_time = time.time_ns() // 1_000_000
 
         # Send 500 messages (should all be allowed)
-        for i in range(500):
-            result = self.simulate_rate_limit_check(
+        allowed = [
+            self.simulate_rate_limit_check(
                 mock_redis_client,
                 phone_number_id,
                 plan_tier,
                 rate_limits,
                 current_time + (i * 10)
-            )
-            assert result["allowed"] is True, f"Message {i+1} should be allowed"
+            )["allowed"]
+            for i in range(500)
+        ]
+        assert all(allowed), f"Message {allowed.index(False) + 1} should be allowed"
 
         # 501st message should be blocked
         result = self.simulate_rate_limit_check(
@@ -298,7 +226,7 @@ class TestRateLimiting:
         """Test that rate limit sliding window resets after 1 hour."""
         phone_number_id = "test_phone_sliding_window"
         plan_tier = "free"
-        current_time = int(time.time() * 1000)
+        current_time = time.time_ns() // 1_000_000
 
         # Send 20 messages at T=0
         for i in range(20):
@@ -335,7 +263,7 @@ class TestRateLimiting:
     def test_different_chatbots_independent_limits(self, mock_redis_client, rate_limits):
         """Test that different chatbots have independent rate limits."""
         plan_tier = "free"
-        current_time = int(time.time() * 1000)
+        current_time = time.time_ns() // 1_000_000
 
         # Chatbot 1: Send 20 messages
         for i in range(20):
@@ -373,7 +301,7 @@ class TestRateLimiting:
         """Test that resetIn is correctly calculated."""
         phone_number_id = "test_phone_reset_time"
         plan_tier = "free"
-        current_time = int(time.time() * 1000)
+        current_time = time.time_ns() // 1_000_000
 
         # Fill up the quota
         for i in range(20):
@@ -400,11 +328,49 @@ class TestRateLimiting:
         # Should be approximately 1 hour minus 20 seconds
         assert 3580 <= result["resetIn"] <= 3600
 
+    def test_blocked_requests_do_not_extend_window(self, mock_redis_client, rate_limits):
+        """Test that rejected requests are not counted against the window."""
+        phone_number_id = "test_phone_blocked_not_counted"
+        plan_tier = "free"
+        current_time = time.time_ns() // 1_000_000
+
+        # Fill up the quota
+        for i in range(20):
+            self.simulate_rate_limit_check(
+                mock_redis_client,
+                phone_number_id,
+                plan_tier,
+                rate_limits,
+                current_time + (i * 1000)
+            )
+
+        # Keep hammering while blocked
+        for i in range(5):
+            result = self.simulate_rate_limit_check(
+                mock_redis_client,
+                phone_number_id,
+                plan_tier,
+                rate_limits,
+                current_time + ((20 + i) * 1000)
+            )
+            assert result["allowed"] is False
+
+        # Once the oldest accepted message expires, exactly one slot frees up
+        result = self.simulate_rate_limit_check(
+            mock_redis_client,
+            phone_number_id,
+            plan_tier,
+            rate_limits,
+            current_time + (3600 * 1000) + 1
+        )
+        assert result["allowed"] is True, "Blocked requests should not consume quota"
+        assert result["current"] == 20
+
     def test_burst_traffic_handling(self, mock_redis_client, rate_limits):
         """Test handling of burst traffic (many messages in short time)."""
         phone_number_id = "test_phone_burst"
         plan_tier = "free"
-        current_time = int(time.time() * 1000)
+        current_time = time.time_ns() // 1_000_000
 
         # Send all 20 messages within 1 second (burst)
         for i in range(20):
@@ -431,7 +397,7 @@ class TestRateLimiting:
         """Test that quota gradually recovers in sliding window."""
         phone_number_id = "test_phone_gradual"
         plan_tier = "free"
-        base_time = int(time.time() * 1000)
+        base_time = time.time_ns() // 1_000_000
 
         # Send 20 messages at base_time
         for i in range(20):
@@ -455,24 +421,11 @@ class TestRateLimiting:
         )
         assert result["allowed"] is True, "Should allow message after oldest entry expires"
 
-    def test_fail_open_behavior_when_redis_unavailable(self, rate_limits):
-        """Test that system allows requests when Redis is unavailable (fail-open)."""
-        # This would be tested in the actual Node.js code
-        # Here we just document the expected behavior
-
-        # When Redis client is None or not connected:
-        # - Should return {"allowed": True}
-        # - Should not throw error
-        # - Better to allow traffic than block legitimate users
-
-        # This is a design decision test
-        assert True  # Placeholder for documentation
-
     def test_current_count_accuracy(self, mock_redis_client, rate_limits):
         """Test that current count is accurately tracked."""
         phone_number_id = "test_phone_count"
         plan_tier = "free"
-        current_time = int(time.time() * 1000)
+        current_time = time.time_ns() // 1_000_000
 
         for i in range(15):
             result = self.simulate_rate_limit_check(
@@ -9,54 +9,68 @@ Tests Step 1's ability to:
 """
 
 import pytest
-import sys
-import os
-from unittest.mock import Mock, patch, MagicMock
+from types import MappingProxyType
+from unittest.mock import MagicMock
 from psycopg2.extras import RealDictCursor
 
-# Add parent directories to path
-sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../../f/development'))
-
-# Mock wmill module before importing step1
-mock_wmill = Mock()
-mock_wmill.get_resource.return_value = {
-    "host": "localhost",
-    "port": 5432,
-    "user": "test_user",
-    "password": "test_password",
-    "dbname": "test_db"
-}
-sys.modules['wmill'] = mock_wmill
-
-# Import the module under test
-import importlib.util
-spec = importlib.util.spec_from_file_location(
-    "step1",
-    os.path.join(os.path.dirname(__file__), '../../f/development/1_whatsapp_context_loading.py')
-)
-step1_module = importlib.util.module_from_spec(spec)
-spec.loader.exec_module(step1_module)
-step1_main = step1_module.main
+from tests.test_harness.db_fakes import FakeConnection, FakeCursor
+
+
+# Rows returned by the Step 1 queries (RealDictCursor returns dicts).
+# Read-only so a test can't leak changes into the next one; build
+# variants with {**ROW, "key": value}.
+NEW_EVENT_ROW = MappingProxyType({"id": 1, "status": "processing", "previous_status": None})
+CHATBOT_ROW = MappingProxyType({
+    "id": "chatbot-123",
+    "organization_id": "org-456",
+    "name": "Test Bot",
+    "system_prompt": "You are helpful",
+    "persona": "Friendly",
+    "model_name": "gemini-pro",
+    "temperature": 0.7,
+    "rag_enabled": False,
+    "whatsapp_access_token": "token_xyz",
+    "is_active": True,
+    "fallback_message_error": "Error occurred",
+    "fallback_message_limit": "Limit reached",
+    "org_is_active": True,
+    "message_limit_monthly": 1000,
+    "token_limit_monthly": 100000,
+    "billing_period_start": "2025-01-01",
+    "billing_period_end": "2025-02-01"
+})
+USAGE_ROW = MappingProxyType({"messages_used": 10, "tokens_used": 5000})
+CONTACT_ROW = MappingProxyType({
+    "id": "contact-789",
+    "conversation_mode": "auto",
+    "variables": {},
+    "tags": []
+})
+
+
+@pytest.fixture
+def fake_db(monkeypatch):
+    """
+    Route psycopg2.connect() to a FakeConnection.
+
+    Call it with the rows the test's queries should return, in order.
+    """
+    def install(fetchone_rows=(), fetchall_rows=()):
+        connection = FakeConnection(FakeCursor(fetchone_rows, fetchall_rows))
+        monkeypatch.setattr("psycopg2.connect", lambda *args, **kwargs: connection)
+
+    return install
 
 
 class TestStep1ContextLoading:
     """Test Step 1's context loading functionality"""
 
-    @patch('psycopg2.connect')
-    def test_duplicate_message_detection(self, mock_connect):
+    def test_duplicate_message_detection(self, fake_db, step1_main):
         """Test that duplicate messages are detected via whatsapp_message_id"""
-        # Setup mock database connection
-        mock_conn = MagicMock()
-        mock_cursor = MagicMock()
-        mock_connect.return_value = mock_conn
-        mock_conn.cursor.return_value = mock_cursor
-
         # Simulate duplicate message already exists (RealDictCursor returns dict-like rows)
-        mock_cursor.fetchone.return_value = {
-            "id": 1,
-            "status": "completed",
-            "processed_at": "2025-01-15 10:00:00"
-        }
+        fake_db(fetchone_rows=[
+            {"id": 1, "status": "completed", "previous_status": "completed"}
+        ])
 
         result = step1_main(
             whatsapp_phone_id="123456123",
@@ -69,20 +83,13 @@ class TestStep1ContextLoading:
         assert result["proceed"] is False
         assert result["reason"] == "Already Processed"
 
-    @patch('psycopg2.connect')
-    def test_chatbot_not_found(self, mock_connect):
+    def test_chatbot_not_found(self, fake_db, step1_main):
         """Test handling when chatbot doesn't exist for phone_number_id"""
-        mock_conn = MagicMock()
-        mock_cursor = MagicMock()
-        mock_connect.return_value = mock_conn
-        mock_conn.cursor.return_value = mock_cursor
-
-        # Setup responses: no duplicate, create webhook event, but no chatbot found
-        mock_cursor.fetchone.side_effect = [
-            None,  # No duplicate message
-            {"id": 999},   # Webhook event ID created (RealDictCursor returns dict)
+        # Setup responses: create webhook event, but no chatbot found
+        fake_db(fetchone_rows=[
+            {"id": 999, "status": "processing", "previous_status": None},  # Webhook event created
             None   # No chatbot found
-        ]
+        ])
 
         result = step1_main(
             whatsapp_phone_id="999999999",  # Non-existent phone ID
@@ -96,56 +103,20 @@ class TestStep1ContextLoading:
         assert result["reason"] == "Chatbot not found"
         assert result["notify_admin"] is True
 
-    @patch('psycopg2.connect')
-    def test_successful_context_loading(self, mock_connect):
+    def test_successful_context_loading(self, fake_db, step1_main):
         """Test successful loading of all context data"""
-        mock_conn = MagicMock()
-        mock_cursor = MagicMock()
-        mock_connect.return_value = mock_conn
-        mock_conn.cursor.return_value = mock_cursor
-
-        # Setup responses
-        mock_cursor.fetchone.side_effect = [
-            None,  # No duplicate
-            {"id": 1},  # Webhook event created
-            {  # Chatbot + organization data
-                "id": "chatbot-123",
-                "organization_id": "org-456",
-                "name": "Test Bot",
-                "system_prompt": "You are helpful",
-                "persona": "Friendly",
-                "model_name": "gemini-pro",
-                "temperature": 0.7,
-                "rag_enabled": False,
-                "whatsapp_access_token": "token_xyz",
-                "is_active": True,
-                "fallback_message_error": "Error occurred",
-                "fallback_message_limit": "Limit reached",
-                "org_name": "Test Org",
-                "plan_tier": "pro",
-                "org_is_active": True,
-                "message_limit_monthly": 1000,
-                "token_limit_monthly": 100000,
-                "billing_period_start": "2025-01-01",
-                "billing_period_end": "2025-02-01"
-            },
-            {  # Usage from get_current_usage()
-                "messages_used": 10,
-                "tokens_used": 5000
-            },
-            {  # Contact upserted
-                "id": "contact-789",
-                "conversation_mode": "auto",
-                "variables": {},
-                "tags": []
-            }
-        ]
-
-        # Mock fetchall queries (tools, history)
-        mock_cursor.fetchall.side_effect = [
-            [],  # No tools/integrations
-            []   # No chat history
-        ]
+        fake_db(
+            fetchone_rows=[
+                NEW_EVENT_ROW,  # Webhook event created
+                CHATBOT_ROW,    # Chatbot + organization data
+                USAGE_ROW,      # Usage from get_current_usage()
+                CONTACT_ROW     # Contact upserted
+            ],
+            fetchall_rows=[
+                [],  # No tools/integrations
+                []   # No chat history
+            ]
+        )
 
         result = step1_main(
             whatsapp_phone_id="123456",
@@ -164,110 +135,34 @@ class TestStep1ContextLoading:
         assert "tools" in result
         assert "usage_info" in result
 
-    @patch('psycopg2.connect')
-    def test_inactive_organization(self, mock_connect):
-        """Test handling when organization is inactive"""
-        mock_conn = MagicMock()
-        mock_cursor = MagicMock()
-        mock_connect.return_value = mock_conn
-        mock_conn.cursor.return_value = mock_cursor
-
-        mock_cursor.fetchone.side_effect = [
-            None,  # No duplicate
-            {"id": 1},  # Webhook event
-            {  # Chatbot with inactive org
-                "id": "bot-123",
-                "organization_id": "org-456",
-                "is_active": True,
-                "org_is_active": False,  # Org is inactive!
-                "message_limit_monthly": 1000,
-                "token_limit_monthly": 100000
-            }
-        ]
-
-        result = step1_main(
-            whatsapp_phone_id="123",
-            user_phone="16315551234",
-            message_id="msg-123",
-            user_name="Test"
-        )
-
-        assert result["proceed"] is False
-        assert result["reason"] == "Service Inactive"
-        assert result["notify_admin"] is True
-
-    @patch('psycopg2.connect')
-    def test_usage_limit_exceeded(self, mock_connect):
-        """Test handling when usage limits are exceeded"""
-        mock_conn = MagicMock()
-        mock_cursor = MagicMock()
-        mock_connect.return_value = mock_conn
-        mock_conn.cursor.return_value = mock_cursor
-
-        mock_cursor.fetchone.side_effect = [
-            None,  # No duplicate
-            {"id": 1},  # Webhook event
-            {  # Chatbot data
-                "id": "bot-123",
-                "organization_id": "org-456",
-                "is_active": True,
-                "org_is_active": True,
-                "message_limit_monthly": 100,  # Low limit
-                "token_limit_monthly": 10000,
-                "billing_period_start": "2025-01-01",
-                "billing_period_end": "2025-02-01",
-                "whatsapp_access_token": "token_xyz"
-            },
-            {  # Usage from get_current_usage() - EXCEEDED!
-                "messages_used": 150,  # Over the limit of 100
-                "tokens_used": 5000
-            }
-        ]
-
-        result = step1_main(
-            whatsapp_phone_id="123",
-            user_phone="16315551234",
-            message_id="msg-123",
-            user_name="Test"
-        )
-
-        assert result["proceed"] is False
-        assert result["reason"] == "Usage Limit Exceeded"
-        assert result["notify_admin"] is True
-        assert "usage_info" in result
-
-    @patch('psycopg2.connect')
-    def test_manual_mode_human_takeover(self, mock_connect):
-        """Test handling when contact is in manual mode"""
-        mock_conn = MagicMock()
-        mock_cursor = MagicMock()
-        mock_connect.return_value = mock_conn
-        mock_conn.cursor.return_value = mock_cursor
-
-        mock_cursor.fetchone.side_effect = [
-            None,  # No duplicate
-            {"id": 1},  # Webhook event
-            {  # Chatbot data
-                "id": "bot-123",
-                "organization_id": "org-456",
-                "is_active": True,
-                "org_is_active": True,
-                "message_limit_monthly": 1000,
-                "token_limit_monthly": 100000,
-                "billing_period_start": "2025-01-01",
-                "billing_period_end": "2025-02-01"
-            },
-            {  # Usage from get_current_usage()
-                "messages_used": 10,
-                "tokens_used": 5000
-            },
-            {  # Contact in manual mode
-                "id": "contact-789",
-                "conversation_mode": "manual",  # Human takeover!
-                "variables": {},
-                "tags": []
-            }
-        ]
+    @pytest.mark.parametrize("bot_overrides,later_rows,expected_reason,notify_admin", [
+        pytest.param(
+            {"org_is_active": False},  # Org is inactive!
+            [],
+            "Service Inactive", True,
+            id="inactive_organization",
+        ),
+        pytest.param(
+            {"message_limit_monthly": 100, "token_limit_monthly": 10000},  # Low limit
+            [{"messages_used": 150, "tokens_used": 5000}],  # Over the limit of 100
+            "Usage Limit Exceeded", True,
+            id="usage_limit_exceeded",
+        ),
+        pytest.param(
+            {},
+            [USAGE_ROW, {**CONTACT_ROW, "conversation_mode": "manual"}],  # Human takeover!
+            "Manual Mode - Human Agent Required", None,
+            id="manual_mode_human_takeover",
+        ),
+    ])
+    def test_request_blocked(self, fake_db, step1_main,
+                             bot_overrides, later_rows, expected_reason, notify_admin):
+        """Test that inactive orgs, exceeded limits and manual mode stop the flow"""
+        fake_db(fetchone_rows=[
+            NEW_EVENT_ROW,
+            {**CHATBOT_ROW, **bot_overrides},
+            *later_rows
+        ])
 
         result = step1_main(
             whatsapp_phone_id="123",
@@ -277,51 +172,11 @@ class TestStep1ContextLoading:
         )
 
         assert result["proceed"] is False
-        assert result["reason"] == "Manual Mode - Human Agent Required"
+        assert result["reason"] == expected_reason
+        assert result.get("notify_admin") is notify_admin
 
-    @patch('psycopg2.connect')
-    def test_chat_history_loading(self, mock_connect):
+    def test_chat_history_loading(self, fake_db, step1_main):
         """Test that chat history is loaded and reversed to chronological order"""
-        mock_conn = MagicMock()
-        mock_cursor = MagicMock()
-        mock_connect.return_value = mock_conn
-        mock_conn.cursor.return_value = mock_cursor
-
-        # Setup basic responses
-        mock_cursor.fetchone.side_effect = [
-            None,  # No duplicate
-            {"id": 1},  # Webhook event
-            {  # Chatbot
-                "id": "bot-123",
-                "organization_id": "org-456",
-                "name": "Test Bot",
-                "system_prompt": "Helpful",
-                "persona": "Friendly",
-                "model_name": "gemini-pro",
-                "temperature": 0.7,
-                "rag_enabled": False,
-                "whatsapp_access_token": "token",
-                "is_active": True,
-                "org_is_active": True,
-                "message_limit_monthly": 1000,
-                "token_limit_monthly": 100000,
-                "billing_period_start": "2025-01-01",
-                "billing_period_end": "2025-02-01",
-                "fallback_message_error": "Error",
-                "fallback_message_limit": "Limit"
-            },
-            {  # Usage from get_current_usage()
-                "messages_used": 10,
-                "tokens_used": 5000
-            },
-            {  # Contact
-                "id": "contact-789",
-                "conversation_mode": "auto",
-                "variables": {},
-                "tags": []
-            }
-        ]
-
         # Mock history (DESC order from DB)
         history_rows = [
             {"role": "assistant", "content": "Response 2", "tool_calls": None, "tool_results": None, "created_at": "2025-01-15 10:02"},
@@ -329,10 +184,13 @@ class TestStep1ContextLoading:
             {"role": "assistant", "content": "Response 1", "tool_calls": None, "tool_results": None, "created_at": "2025-01-15 10:00"}
         ]
 
-        mock_cursor.fetchall.side_effect = [
-            [],  # Tools
-            history_rows  # History
-        ]
+        fake_db(
+            fetchone_rows=[NEW_EVENT_ROW, CHATBOT_ROW, USAGE_ROW, CONTACT_ROW],
+            fetchall_rows=[
+                [],  # Tools
+                history_rows  # History
+            ]
+        )
 
         result = step1_main(
             whatsapp_phone_id="123",
@@ -347,11 +205,13 @@ class TestStep1ContextLoading:
         assert result["history"][0]["content"] == "Response 1"  # Oldest
         assert result["history"][2]["content"] == "Response 2"  # Newest
 
-    @patch('psycopg2.connect')
-    def test_db_connection_error(self, mock_connect):
+    def test_db_connection_error(self, monkeypatch, step1_main):
         """Test handling of database connection failures"""
         # Simulate connection failure
-        mock_connect.side_effect = Exception("Connection refused")
+        def refuse_connection(*args, **kwargs):
+            raise Exception("Connection refused")
+
+        monkeypatch.setattr("psycopg2.connect", refuse_connection)
 
         result = step1_main(
             whatsapp_phone_id="123",
@@ -364,52 +224,21 @@ class TestStep1ContextLoading:
         assert "DB Connection Failed" in result["reason"]
         assert result["notify_admin"] is True
 
-    @patch('psycopg2.connect')
-    def test_retry_failed_message(self, mock_connect):
+    def test_retry_failed_message(self, fake_db, step1_main):
         """Test that failed messages can be retried"""
-        mock_conn = MagicMock()
-        mock_cursor = MagicMock()
-        mock_connect.return_value = mock_conn
-        mock_conn.cursor.return_value = mock_cursor
-
         # Setup: message exists with 'failed' status
-        mock_cursor.fetchone.side_effect = [
-            {"id": 1, "status": "failed", "processed_at": "2025-01-15 10:00"},  # Failed message
-            {  # Chatbot (after retry allowed)
-                "id": "bot-123",
-                "organization_id": "org-456",
-                "name": "Test Bot",
-                "system_prompt": "Helpful",
-                "persona": "Friendly",
-                "model_name": "gemini-pro",
-                "temperature": 0.7,
-                "rag_enabled": False,
-                "whatsapp_access_token": "token",
-                "is_active": True,
-                "org_is_active": True,
-                "message_limit_monthly": 1000,
-                "token_limit_monthly": 100000,
-                "billing_period_start": "2025-01-01",
-                "billing_period_end": "2025-02-01",
-                "fallback_message_error": "Error",
-                "fallback_message_limit": "Limit"
-            },
-            {  # Usage from get_current_usage()
-                "messages_used": 10,
-                "tokens_used": 5000
-            },
-            {  # Contact
-                "id": "contact-789",
-                "conversation_mode": "auto",
-                "variables": {},
-                "tags": []
-            }
-        ]
-
-        mock_cursor.fetchall.side_effect = [
-            [],  # No tools
-            []   # No history
-        ]
+        fake_db(
+            fetchone_rows=[
+                {"id": 1, "status": "processing", "previous_status": "failed"},  # Failed message reclaimed
+                CHATBOT_ROW,  # Chatbot (after retry allowed)
+                USAGE_ROW,
+                CONTACT_ROW
+            ],
+            fetchall_rows=[
+                [],  # No tools
+                []   # No history
+            ]
+        )
 
         result = step1_main(
             whatsapp_phone_id="123",
@@ -9,859 +9,657 @@ Tests Step 2's ability to:
 - Return proper response structure
 """
 
+import copy
 import pytest
-import sys
-import os
-from unittest.mock import Mock, patch, MagicMock
-from collections import namedtuple
+import requests
+from unittest.mock import MagicMock
 from contextlib import contextmanager
+from dataclasses import dataclass
+from types import SimpleNamespace
+
+from tests.test_harness.db_fakes import FakeConnection, FakeCursor
+
+
+# Keep the Step 2 modules on one worker under --dist=loadgroup
+pytestmark = pytest.mark.xdist_group("step2")
+
+
+# Simple classes to hold usage metadata
+@dataclass(frozen=True, slots=True)
+class UsageMetadata:
+    prompt_token_count: int
+    candidates_token_count: int
+
+
+@dataclass(frozen=True, slots=True)
+class PromptTokensDetails:
+    cached_tokens: int
+
+
+@dataclass(frozen=True, slots=True)
+class OpenAIUsage:
+    prompt_tokens: int
+    completion_tokens: int
+    prompt_tokens_details: PromptTokensDetails | None = None
+
+
+# Query embedding returned by the OpenAI embeddings API; a tuple so it can't
+# be changed, handed out as a fresh list like the real API returns
+FAKE_EMBEDDING = (0.1,) * 1536
 
-# Add parent directories to path
-sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../../f/development'))
+# Knowledge base chunk returned by the RAG similarity search
+RAG_CHUNK_ROW = {
+    "content": "Relevant information from knowledge base",
+    "source_name": "Product Manual",
+    "similarity": 0.85,
+    "metadata": {"page": 5}
+}
 
-# Mock required modules before importing step2
-mock_wmill = Mock()
-mock_wmill.get_variable.return_value = "fake_google_api_key"
-sys.modules['wmill'] = mock_wmill
+# retrieve_knowledge results keyed on (chatbot_id, query); unknown keys find nothing
+RAG_SEARCH_TABLE = {
+    ("chatbot-123", "product info"): [{
+        "content": "Information about product",
+        "source_name": "Manual",
+        "similarity": 0.9,
+        "metadata": {"page": 10}
+    }],
+    ("chatbot-123", "unknown topic"): [],
+}
 
-# Mock Google GenAI SDK
-mock_genai = Mock()
-mock_genai_types = Mock()
-sys.modules['google.genai'] = mock_genai
-sys.modules['google.genai.types'] = mock_genai_types
+# Minimal Step 1 payload for a Gemini bot; copied per test by context_payload
+BASE_CONTEXT_PAYLOAD = {
+    "proceed": True,
+    "chatbot": {
+        "id": "test",
+        "model_name": "gemini-pro",
+        "system_prompt": "Test",
+        "persona": "",
+        "temperature": 0.7,
+        "rag_config": {"enabled": False}
+    },
+    "user": {"id": "test", "phone": "123", "name": "Test", "variables": {}},
+    "history": [],
+    "tools": []
+}
 
-# Import the module under test
-import importlib.util
-spec = importlib.util.spec_from_file_location(
-    "step2",
-    os.path.join(os.path.dirname(__file__), '../../f/development/2_whatsapp_llm_processing.py')
-)
-step2_module = importlib.util.module_from_spec(spec)
-spec.loader.exec_module(step2_module)
-step2_main = step2_module.main
+# Step 1 rejected the message; main only reads it, so it is passed as is
+STEP1_FAILURE_PAYLOAD = {
+    "proceed": False,
+    "reason": "User is blocked",
+    "notify_admin": True
+}
 
-# Simple class to hold usage metadata
-UsageMetadata = namedtuple('UsageMetadata', ['prompt_token_count', 'candidates_token_count'])
-OpenAIUsage = namedtuple('OpenAIUsage', ['prompt_tokens', 'completion_tokens'])
+
+def gemini_response(text, prompt_tokens, output_tokens):
+    """Plain Gemini response without tool calls; also usable as the agent loop's final answer."""
+    text_part = SimpleNamespace(text=text, function_call=None)
+    return SimpleNamespace(
+        text=text,
+        candidates=[SimpleNamespace(content=SimpleNamespace(parts=[text_part]))],
+        usage_metadata=UsageMetadata(prompt_tokens, output_tokens)
+    )
+
+
+def openai_response(content, usage, finish_reason="stop", tool_calls=None):
+    """OpenAI chat completion with a single choice."""
+    message = SimpleNamespace(content=content, tool_calls=tool_calls)
+    return SimpleNamespace(
+        choices=[SimpleNamespace(message=message, finish_reason=finish_reason)],
+        usage=usage
+    )
+
+
+def openai_tool_call(call_id, name, arguments):
+    """Tool call entry of an OpenAI assistant message."""
+    return SimpleNamespace(id=call_id, function=SimpleNamespace(name=name, arguments=arguments))
+
+
+def assert_usage(result, **expected):
+    """Check the given usage_info fields; a failure diff lists every mismatch at once."""
+    usage_info = result["usage_info"]
+    assert {key: usage_info.get(key) for key in expected} == expected
+
+
+def returning(*responses):
+    """Client method stand-in that returns the given responses in order, without call recording."""
+    remaining = iter(responses)
+    return lambda *args, **kwargs: next(remaining)
+
+
+def raising(error):
+    """Stand-in that raises the given exception on every call."""
+    def raise_error(*args, **kwargs):
+        raise error
+    return raise_error
+
+
+def recording(calls, result):
+    """Stand-in that appends (args, kwargs) to calls and returns result."""
+    def record(*args, **kwargs):
+        calls.append((args, kwargs))
+        return result
+    return record
+
+
+def openai_stub(create):
+    """OpenAI client exposing chat.completions.create."""
+    return SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+
+
+def gemini_stub(generate_content):
+    """GenAI client exposing models.generate_content."""
+    return SimpleNamespace(models=SimpleNamespace(generate_content=generate_content))
+
+
+@pytest.fixture
+def context_payload():
+    """Fresh copy of BASE_CONTEXT_PAYLOAD for the test to adjust."""
+    return copy.deepcopy(BASE_CONTEXT_PAYLOAD)
+
+
+@pytest.fixture
+def no_model_fallback(monkeypatch, step2_module):
+    """Only try the chatbot's own provider/model, so its error is the final one."""
+    monkeypatch.setattr(step2_module, 'MODEL_FALLBACK_CHAIN', [])
+
+
+@pytest.fixture(autouse=True)
+def clear_rag_cache(step2_module):
+    """Start every test with an empty knowledge base cache."""
+    step2_module._rag_cache_clear()
+
+
+@pytest.fixture
+def table_retrieve(monkeypatch, step2_module):
+    """Serve retrieve_knowledge from RAG_SEARCH_TABLE."""
+    def retrieve_knowledge(chatbot_id, query, **kwargs):
+        return RAG_SEARCH_TABLE.get((chatbot_id, query), [])
+    monkeypatch.setattr(step2_module, 'retrieve_knowledge', retrieve_knowledge)
 
 
 class TestStep2LLMProcessing:
     """Test Step 2's LLM processing functionality"""
 
-    def test_simple_gemini_response_no_tools(self):
-        """Test simple Gemini response without tools or RAG"""
-        # Setup mock Gemini client
-        mock_client = Mock()
-        mock_models = Mock()
-
-        # Create mock response
-        mock_response = Mock()
-        mock_response.text = "Hello! How can I help you today?"
-        mock_response.usage_metadata = UsageMetadata(
-            prompt_token_count=50,
-            candidates_token_count=20
+    @pytest.mark.parametrize("overrides,call_kwargs,reply_text", [
+        pytest.param(
+            {"chatbot": {
+                "id": "chatbot-123",
+                "organization_id": "org-456",
+                "system_prompt": "You are a helpful assistant.",
+                "persona": "Friendly and professional"
+            }},
+            {"default_provider": "google"},
+            "Hello! How can I help you today?",
+            id="simple_gemini_response_no_tools",
+        ),
+        pytest.param(
+            {"chatbot": {"model_name": "gemini-3-flash-preview"}},  # Contains "gemini"
+            {"default_provider": "openai"},  # Default is openai, but should switch to google
+            "Response",
+            id="provider_detection_from_model_name",
+        ),
+        pytest.param(
+            {"chatbot": {"system_prompt": "You are helpful"}, "history": [
+                {"role": "user", "content": "Previous question"},
+                {"role": "assistant", "content": "Previous answer"}
+            ]},
+            {},
+            "Response with history",
+            id="conversation_history_formatting",
+        ),
+        pytest.param(
+            {"chatbot": {"system_prompt": "You are helpful", "persona": "Professional"}, "user": {
+                "id": "user-123",
+                "phone": "5551234567",
+                "name": "John Doe",
+                "variables": {"preferred_language": "Spanish", "tier": "premium"}
+            }},
+            {},
+            "Response",
+            id="user_context_injection",
+        ),
+        pytest.param({}, {}, "First message response", id="empty_history_handling"),
+    ])
+    def test_gemini_response_no_tools(self, step2_main, gemini_client, context_payload,
+                                      overrides, call_kwargs, reply_text):
+        """Test plain Gemini responses (no tools or RAG) across payload variants"""
+        gemini_client.models.generate_content.return_value = gemini_response(reply_text, 50, 20)
+        context_payload["chatbot"].update(overrides.get("chatbot", {}))
+        for key in ("user", "history"):
+            if key in overrides:
+                context_payload[key] = overrides[key]
+
+        result = step2_main(
+            context_payload=context_payload,
+            user_message="Hello",
+            google_api_key="fake_key",
+            **call_kwargs
         )
 
-        mock_models.generate_content = Mock(return_value=mock_response)
-        mock_client.models = mock_models
-
-        with patch.object(mock_genai, 'Client', return_value=mock_client):
-            result = step2_main(
-                context_payload={
-                    "proceed": True,
-                    "chatbot": {
-                        "id": "chatbot-123",
-                        "organization_id": "org-456",
-                        "model_name": "gemini-pro",
-                        "system_prompt": "You are a helpful assistant.",
-                        "persona": "Friendly and professional",
-                        "temperature": 0.7,
-                        "rag_config": {"enabled": False}
-                    },
-                    "user": {
-                        "id": "user-789",
-                        "phone": "1234567890",
-                        "name": "Test User",
-                        "variables": {}
-                    },
-                    "history": [],
-                    "tools": []
-                },
-                user_message="Hello",
-                google_api_key="fake_key",
-                default_provider="google"
-            )
+        gemini_client.models.generate_content.assert_called_once()
+        assert "error" not in result
+        assert result["reply_text"] == reply_text
+        assert_usage(
+            result,
+            provider="google",
+            model=context_payload["chatbot"]["model_name"],
+            tokens_input=50,
+            tokens_output=20,
+            chunks_retrieved=0
+        )
+        assert result["usage_info"]["rag_used"] is False
+        assert len(result["tool_executions"]) == 0
 
-            # Assertions
-            assert "error" not in result
-            assert result["reply_text"] == "Hello! How can I help you today?"
-            assert result["usage_info"]["provider"] == "google"
-            assert result["usage_info"]["model"] == "gemini-pro"
-            assert result["usage_info"]["tokens_input"] == 50
-            assert result["usage_info"]["tokens_output"] == 20
-            assert result["usage_info"]["rag_used"] is False
-            assert result["usage_info"]["chunks_retrieved"] == 0
-            assert len(result["tool_executions"]) == 0
-
-    def test_simple_openai_response_no_tools(self):
+    def test_simple_openai_response_no_tools(self, step2_main, openai_client, context_payload):
         """Test simple OpenAI response without tools or RAG"""
-        # Setup mock OpenAI client
-        mock_client = Mock()
-
-        # Create mock response
-        mock_message = Mock()
-        mock_message.content = "I'd be happy to help!"
+        openai_client.chat.completions.create.return_value = openai_response(
+            "I'd be happy to help!", OpenAIUsage(
+                prompt_tokens=100,
+                completion_tokens=40
+            )
+        )
 
-        mock_choice = Mock()
-        mock_choice.message = mock_message
+        context_payload["chatbot"].update({
+            "id": "chatbot-123",
+            "organization_id": "org-456",
+            "model_name": "gpt-4o",
+            "system_prompt": "You are a helpful assistant.",
+            "persona": "Concise and clear"
+        })
+        context_payload["user"] = {
+            "id": "user-789",
+            "phone": "1234567890",
+            "name": "Test User",
+            "variables": {}
+        }
 
-        mock_response = Mock()
-        mock_response.choices = [mock_choice]
-        mock_response.usage = OpenAIUsage(
-            prompt_tokens=100,
-            completion_tokens=40
+        result = step2_main(
+            context_payload=context_payload,
+            user_message="Hello",
+            openai_api_key="fake_openai_key",
+            default_provider="openai"
         )
 
-        mock_client.chat = Mock()
-        mock_client.chat.completions = Mock()
-        mock_client.chat.completions.create = Mock(return_value=mock_response)
-
-        # Patch OpenAI in the step2_module namespace where it's imported
-        with patch.object(step2_module, 'OpenAI', return_value=mock_client):
-            result = step2_main(
-                context_payload={
-                    "proceed": True,
-                    "chatbot": {
-                        "id": "chatbot-123",
-                        "organization_id": "org-456",
-                        "model_name": "gpt-4o",
-                        "system_prompt": "You are a helpful assistant.",
-                        "persona": "Concise and clear",
-                        "temperature": 0.7,
-                        "rag_config": {"enabled": False}
-                    },
-                    "user": {
-                        "id": "user-789",
-                        "phone": "1234567890",
-                        "name": "Test User",
-                        "variables": {}
-                    },
-                    "history": [],
-                    "tools": []
-                },
-                user_message="Hello",
-                openai_api_key="fake_openai_key",
-                default_provider="openai"
-            )
-
-            # Assertions
-            assert "error" not in result
-            assert result["reply_text"] == "I'd be happy to help!"
-            assert result["usage_info"]["provider"] == "openai"
-            assert result["usage_info"]["model"] == "gpt-4o"
-            assert result["usage_info"]["tokens_input"] == 100
-            assert result["usage_info"]["tokens_output"] == 40
-            assert result["usage_info"]["rag_used"] is False
-
-    def test_provider_detection_from_model_name(self):
-        """Test that provider is correctly detected from model_name"""
-        # Test Gemini detection
-        mock_client = Mock()
-        mock_models = Mock()
-        mock_response = Mock()
-        mock_response.text = "Response"
-        mock_response.usage_metadata = UsageMetadata(50, 20)
-        mock_models.generate_content = Mock(return_value=mock_response)
-        mock_client.models = mock_models
-
-        with patch.object(mock_genai, 'Client', return_value=mock_client):
-            result = step2_main(
-                context_payload={
-                    "proceed": True,
-                    "chatbot": {
-                        "id": "test",
-                        "model_name": "gemini-3-flash-preview",  # Contains "gemini"
-                        "system_prompt": "Test",
-                        "persona": "",
-                        "temperature": 0.7,
-                        "rag_config": {"enabled": False}
-                    },
-                    "user": {"id": "test", "phone": "123", "name": "Test", "variables": {}},
-                    "history": [],
-                    "tools": []
-                },
-                user_message="Test",
-                google_api_key="fake_key",
-                default_provider="openai"  # Default is openai, but should switch to google
-            )
+        # Assertions
+        assert "error" not in result
+        assert result["reply_text"] == "I'd be happy to help!"
+        assert_usage(result, provider="openai", model="gpt-4o", tokens_input=100, tokens_output=40)
+        assert result["usage_info"]["rag_used"] is False
 
-            assert result["usage_info"]["provider"] == "google"
-
-    def test_conversation_history_formatting(self):
-        """Test that conversation history is properly formatted for LLM"""
-        mock_client = Mock()
-        mock_models = Mock()
-        mock_response = Mock()
-        mock_response.text = "Response with history"
-        mock_response.usage_metadata = UsageMetadata(150, 30)
-        mock_models.generate_content = Mock(return_value=mock_response)
-        mock_client.models = mock_models
-
-        with patch.object(mock_genai, 'Client', return_value=mock_client):
-            result = step2_main(
-                context_payload={
-                    "proceed": True,
-                    "chatbot": {
-                        "id": "test",
-                        "model_name": "gemini-pro",
-                        "system_prompt": "You are helpful",
-                        "persona": "",
-                        "temperature": 0.7,
-                        "rag_config": {"enabled": False}
-                    },
-                    "user": {"id": "test", "phone": "123", "name": "Test", "variables": {}},
-                    "history": [
-                        {"role": "user", "content": "Previous question"},
-                        {"role": "assistant", "content": "Previous answer"}
-                    ],
-                    "tools": []
-                },
-                user_message="Follow-up question",
-                google_api_key="fake_key"
-            )
+    def test_openai_cached_tokens_reported(self, step2_main, openai_client, context_payload):
+        """Test that prompt-cache hits reported by OpenAI are passed through in usage_info"""
+        openai_client.chat.completions.create.return_value = openai_response(
+            "Cached reply", OpenAIUsage(2006, 300, PromptTokensDetails(cached_tokens=1920))
+        )
+        context_payload["chatbot"]["model_name"] = "gpt-4o"
 
-            # Verify generate_content was called
-            assert mock_models.generate_content.called
-
-            # The call should include conversation history
-            call_args = mock_models.generate_content.call_args
-            assert call_args is not None
-
-    def test_user_context_injection(self):
-        """Test that user context (name, phone, variables) is injected into prompt"""
-        mock_client = Mock()
-        mock_models = Mock()
-        mock_response = Mock()
-        mock_response.text = "Response"
-        mock_response.usage_metadata = UsageMetadata(50, 20)
-        mock_models.generate_content = Mock(return_value=mock_response)
-        mock_client.models = mock_models
-
-        with patch.object(mock_genai, 'Client', return_value=mock_client):
-            result = step2_main(
-                context_payload={
-                    "proceed": True,
-                    "chatbot": {
-                        "id": "test",
-                        "model_name": "gemini-pro",
-                        "system_prompt": "You are helpful",
-                        "persona": "Professional",
-                        "temperature": 0.7,
-                        "rag_config": {"enabled": False}
-                    },
-                    "user": {
-                        "id": "user-123",
-                        "phone": "5551234567",
-                        "name": "John Doe",
-                        "variables": {"preferred_language": "Spanish", "tier": "premium"}
-                    },
-                    "history": [],
-                    "tools": []
-                },
-                user_message="Hello",
-                google_api_key="fake_key"
-            )
+        result = step2_main(
+            context_payload=context_payload,
+            user_message="Hello",
+            openai_api_key="fake_openai_key",
+            default_provider="openai"
+        )
 
-            assert result["reply_text"] == "Response"
-            # User context should be included in the system prompt
-            # We can verify this by checking the generate_content call
+        assert result["usage_info"]["tokens_input"] == 2006
+        assert result["usage_info"]["tokens_cached"] == 1920
 
-    def test_rag_context_injection(self):
+    def test_rag_context_injection(self, monkeypatch, step2_module, step2_main, openai_client, gemini_client, context_payload):
         """Test that RAG context is properly injected when enabled"""
         # Mock OpenAI for embeddings
-        mock_openai_client = Mock()
-        mock_embedding_response = Mock()
-        mock_embedding_response.data = [Mock(embedding=[0.1] * 1536)]
-        mock_openai_client.embeddings = Mock()
-        mock_openai_client.embeddings.create = Mock(return_value=mock_embedding_response)
-
-        # Mock database connection for RAG retrieval
-        mock_conn = Mock()
-        mock_cursor = Mock()
-        mock_cursor.fetchall = Mock(return_value=[
-            {
-                "content": "Relevant information from knowledge base",
-                "source_name": "Product Manual",
-                "similarity": 0.85,
-                "metadata": {"page": 5}
-            }
-        ])
-        mock_conn.cursor = Mock(return_value=mock_cursor)
-
-        # Mock Gemini response - simple response without tools (no agent loop)
-        mock_gemini_client = Mock()
-        mock_models = Mock()
-        mock_response = Mock()
-        mock_response.text = "Based on the knowledge base, here's the answer..."
-        mock_response.usage_metadata = UsageMetadata(200, 50)
-        mock_models.generate_content = Mock(return_value=mock_response)
-        mock_gemini_client.models = mock_models
+        openai_client.embeddings.create.return_value = SimpleNamespace(
+            data=[SimpleNamespace(embedding=list(FAKE_EMBEDDING))]
+        )
+
+        # Database connection for RAG retrieval: one matching chunk
+        fake_cursor = FakeCursor(fetchall_rows=[[RAG_CHUNK_ROW]])
+        fake_conn = FakeConnection(fake_cursor)
+
+        # RAG registers search_knowledge_base, so Gemini runs the agent loop;
+        # answer straight away without calling it
+        gemini_client.models.generate_content.return_value = gemini_response(
+            "Based on the knowledge base, here's the answer...", 200, 50
+        )
+
+        # Record the prompt text handed to Gemini
+        prompt_parts = []
+        monkeypatch.setattr(step2_module.types, 'Part',
+                            lambda **kwargs: prompt_parts.append(kwargs) or SimpleNamespace(**kwargs))
 
         # Create mock context manager for get_db_connection
         @contextmanager
         def mock_get_db_connection(*args, **kwargs):
-            yield mock_conn, mock_cursor
-
-        # Patch OpenAI in the step2_module namespace
-        with patch.object(step2_module, 'OpenAI', return_value=mock_openai_client), \
-             patch.object(step2_module, 'get_db_connection', mock_get_db_connection), \
-             patch.object(mock_genai, 'Client', return_value=mock_gemini_client):
-
-            result = step2_main(
-                context_payload={
-                    "proceed": True,
-                    "chatbot": {
-                        "id": "chatbot-123",
-                        "model_name": "gemini-pro",
-                        "system_prompt": "You are helpful",
-                        "persona": "",
-                        "temperature": 0.7,
-                        "rag_config": {"enabled": True}  # RAG enabled!
-                    },
-                    "user": {"id": "test", "phone": "123", "name": "Test", "variables": {}},
-                    "history": [],
-                    "tools": []
-                },
-                user_message="How do I use the product?",
-                openai_api_key="fake_openai_key",  # For embeddings
-                google_api_key="fake_google_key",
-                db_resource="f/development/business_layer_db_postgreSQL"
-            )
+            yield fake_conn, fake_cursor
 
-            # Assertions
-            assert result["usage_info"]["rag_used"] is True
-            assert result["usage_info"]["chunks_retrieved"] == 1
-            assert len(result["retrieved_sources"]) == 1
-            assert result["retrieved_sources"][0]["source_name"] == "Product Manual"
-            assert result["retrieved_sources"][0]["similarity"] == 0.85
-
-    def test_llm_error_handling(self):
-        """Test LLM error handling with fallback messages"""
-        mock_client = Mock()
-        mock_models = Mock()
-
-        # Simulate LLM error
-        mock_models.generate_content = Mock(side_effect=Exception("API Error"))
-        mock_client.models = mock_models
-
-        with patch.object(mock_genai, 'Client', return_value=mock_client):
-            result = step2_main(
-                context_payload={
-                    "proceed": True,
-                    "chatbot": {
-                        "id": "test",
-                        "model_name": "gemini-pro",
-                        "system_prompt": "Test",
-                        "persona": "",
-                        "temperature": 0.7,
-                        "rag_config": {"enabled": False},
-                        "fallback_message_error": "Custom error message",
-                        "fallback_message_limit": "Custom limit message"
-                    },
-                    "user": {"id": "test", "phone": "123", "name": "Test", "variables": {}},
-                    "history": [],
-                    "tools": []
-                },
-                user_message="Test",
-                google_api_key="fake_key"
-            )
+        monkeypatch.setattr(step2_module, 'get_db_connection', mock_get_db_connection)
+        context_payload["chatbot"].update({
+            "id": "chatbot-123",
+            "system_prompt": "You are helpful",
+            "rag_config": {"enabled": True}  # RAG enabled!
+        })
 
-            # Should return fallback message
-            assert result["reply_text"] == "Custom error message"
-            assert result["usage_info"]["error"] == "API Error"
-            assert result["usage_info"]["is_limit_error"] is False
-
-    def test_quota_limit_error_handling(self):
-        """Test quota/limit error detection and appropriate fallback message"""
-        mock_client = Mock()
-        mock_models = Mock()
-
-        # Simulate quota error
-        mock_models.generate_content = Mock(side_effect=Exception("429 Quota exceeded"))
-        mock_client.models = mock_models
-
-        with patch.object(mock_genai, 'Client', return_value=mock_client):
-            result = step2_main(
-                context_payload={
-                    "proceed": True,
-                    "chatbot": {
-                        "id": "test",
-                        "model_name": "gemini-pro",
-                        "system_prompt": "Test",
-                        "persona": "",
-                        "temperature": 0.7,
-                        "rag_config": {"enabled": False},
-                        "fallback_message_error": "Error message",
-                        "fallback_message_limit": "Quota exceeded message"
-                    },
-                    "user": {"id": "test", "phone": "123", "name": "Test", "variables": {}},
-                    "history": [],
-                    "tools": []
-                },
-                user_message="Test",
-                google_api_key="fake_key"
-            )
+        result = step2_main(
+            context_payload=context_payload,
+            user_message="How do I use the product?",
+            openai_api_key="fake_openai_key",  # For embeddings
+            google_api_key="fake_google_key",
+            db_resource="f/development/business_layer_db_postgreSQL"
+        )
 
-            # Should return limit fallback message
-            assert result["reply_text"] == "Quota exceeded message"
-            assert result["usage_info"]["is_limit_error"] is True
+        # Assertions
+        assert result["usage_info"]["rag_used"] is True
+        assert result["usage_info"]["chunks_retrieved"] == 1
+        assert len(result["retrieved_sources"]) == 1
+        assert result["retrieved_sources"][0]["source_name"] == "Product Manual"
+        assert result["retrieved_sources"][0]["similarity"] == 0.85
+        assert result["reply_text"] == "Based on the knowledge base, here's the answer..."
+
+        prompt = prompt_parts[0]["text"]
+        assert "=== KNOWLEDGE BASE CONTEXT ===" in prompt
+        assert RAG_CHUNK_ROW["content"] in prompt
+        assert "[Source: Product Manual, Page 5, Relevance: 85%]" in prompt
+
+    @pytest.mark.parametrize("error,reply_text,is_limit_error", [
+        pytest.param(Exception("API Error"), "Custom error message", False, id="llm_error"),
+        pytest.param(Exception("429 Quota exceeded"), "Custom limit message", True, id="quota_limit_error"),
+    ])
+    def test_llm_error_fallback_message(self, step2_main, gemini_client, context_payload,
+                                        error, reply_text, is_limit_error):
+        """Test LLM error handling: quota/limit errors get the limit fallback, others the error fallback"""
+        gemini_client.models.generate_content.side_effect = error
+        context_payload["chatbot"].update({
+            "fallback_message_error": "Custom error message",
+            "fallback_message_limit": "Custom limit message"
+        })
 
-    def test_missing_api_key_error(self):
-        """Test handling when API key is missing"""
         result = step2_main(
-            context_payload={
-                "proceed": True,
-                "chatbot": {
-                    "id": "test",
-                    "model_name": "gpt-4",
-                    "system_prompt": "Test",
-                    "persona": "",
-                    "temperature": 0.7,
-                    "rag_config": {"enabled": False}
-                },
-                "user": {"id": "test", "phone": "123", "name": "Test", "variables": {}},
-                "history": [],
-                "tools": []
-            },
+            context_payload=context_payload,
             user_message="Test",
-            openai_api_key="",  # Missing API key
-            default_provider="openai"
+            google_api_key="fake_key"
         )
 
-        assert result["error"] == "Missing OpenAI API Key"
-
-    def test_empty_history_handling(self):
-        """Test that empty history is handled correctly"""
-        mock_client = Mock()
-        mock_models = Mock()
-        mock_response = Mock()
-        mock_response.text = "First message response"
-        mock_response.usage_metadata = UsageMetadata(50, 20)
-        mock_models.generate_content = Mock(return_value=mock_response)
-        mock_client.models = mock_models
-
-        with patch.object(mock_genai, 'Client', return_value=mock_client):
-            result = step2_main(
-                context_payload={
-                    "proceed": True,
-                    "chatbot": {
-                        "id": "test",
-                        "model_name": "gemini-pro",
-                        "system_prompt": "Test",
-                        "persona": "",
-                        "temperature": 0.7,
-                        "rag_config": {"enabled": False}
-                    },
-                    "user": {"id": "test", "phone": "123", "name": "Test", "variables": {}},
-                    "history": [],  # Empty history
-                    "tools": []
-                },
-                user_message="First message",
-                google_api_key="fake_key"
-            )
+        assert result["reply_text"] == reply_text
+        assert result["usage_info"]["error"] == str(error)
+        assert result["usage_info"]["is_limit_error"] is is_limit_error
 
-            assert "error" not in result
-            assert result["reply_text"] == "First message response"
+    @pytest.mark.parametrize("provider,model_name,key_kwarg,expected_error", [
+        pytest.param("openai", "gpt-4", "openai_api_key", "Missing OpenAI API Key", id="openai"),
+        pytest.param("google", "gemini-pro", "google_api_key", "Missing Google API Key", id="google"),
+    ])
+    def test_missing_api_key_error(self, step2_main, context_payload, no_model_fallback,
+                                   provider, model_name, key_kwarg, expected_error):
+        """Test that a missing API key for the selected provider is reported in usage_info"""
+        context_payload["chatbot"]["model_name"] = model_name
 
-    def test_rag_disabled_no_retrieval(self):
+        result = step2_main(
+            context_payload=context_payload,
+            user_message="Test",
+            default_provider=provider,
+            **{key_kwarg: ""}  # Missing API key
+        )
+
+        assert "error" not in result  # main returns the all-failed reply, not a Step 1 style error
+        assert_usage(result, provider="failed", model="all_failed",
+                     error=expected_error, is_limit_error=False)
+
+    def test_context_payload_not_mutated(self, step2_main, gemini_client, context_payload):
+        """Test that main only reads context_payload, so shared payload templates stay intact"""
+        gemini_client.models.generate_content.return_value = gemini_response("Response", 50, 20)
+        context_payload["history"] = [{"role": "user", "content": "Previous question"}]
+        context_payload["tools"] = [{
+            "provider": "mcp",
+            "name": "test_tool",
+            "config": {"description": "Test tool", "parameters": {}}
+        }]
+        original = copy.deepcopy(context_payload)
+
+        step2_main(
+            context_payload=context_payload,
+            user_message="Hello",
+            google_api_key="fake_key"
+        )
+
+        assert context_payload == original
+
+    def test_rag_disabled_no_retrieval(self, monkeypatch, step2_module, step2_main, gemini_client, context_payload):
         """Test that RAG retrieval is skipped when disabled"""
-        mock_client = Mock()
-        mock_models = Mock()
-        mock_response = Mock()
-        mock_response.text = "Response without RAG"
-        mock_response.usage_metadata = UsageMetadata(50, 20)
-        mock_models.generate_content = Mock(return_value=mock_response)
-        mock_client.models = mock_models
-
-        with patch.object(mock_genai, 'Client', return_value=mock_client), \
-             patch.object(step2_module, 'OpenAI') as mock_openai:
-
-            result = step2_main(
-                context_payload={
-                    "proceed": True,
-                    "chatbot": {
-                        "id": "test",
-                        "model_name": "gemini-pro",
-                        "system_prompt": "Test",
-                        "persona": "",
-                        "temperature": 0.7,
-                        "rag_config": {"enabled": False}  # RAG disabled
-                    },
-                    "user": {"id": "test", "phone": "123", "name": "Test", "variables": {}},
-                    "history": [],
-                    "tools": []
-                },
-                user_message="Question",
-                openai_api_key="fake_key",
-                google_api_key="fake_key"
-            )
+        gemini_client.models.generate_content.return_value = gemini_response("Response without RAG", 50, 20)
+        assert context_payload["chatbot"]["rag_config"] == {"enabled": False}  # RAG disabled
+        openai_clients = []
+        monkeypatch.setattr(step2_module, 'OpenAI', lambda *args, **kwargs: openai_clients.append(args))
+
+        result = step2_main(
+            context_payload=context_payload,
+            user_message="Question",
+            openai_api_key="fake_key",
+            google_api_key="fake_key"
+        )
 
-            # OpenAI should not be called for embeddings when RAG is disabled
-            assert not mock_openai.called
-            assert result["usage_info"]["rag_used"] is False
-            assert result["usage_info"]["chunks_retrieved"] == 0
-            assert len(result["retrieved_sources"]) == 0
+        # No OpenAI client should be created for embeddings when RAG is disabled
+        assert openai_clients == []
+        assert result["usage_info"]["rag_used"] is False
+        assert result["usage_info"]["chunks_retrieved"] == 0
+        assert len(result["retrieved_sources"]) == 0
 
-    def test_openai_history_with_content(self):
+    def test_openai_history_with_content(self, step2_main, openai_client, context_payload):
         """
         GOAL: Test that OpenAI history includes only messages with content
         GIVEN: History with messages that have and don't have content
         WHEN: main is called with OpenAI
         THEN: Only messages with content are added to conversation
         """
-        mock_client = Mock()
-        mock_message = Mock()
-        mock_message.content = "Response"
-        mock_choice = Mock()
-        mock_choice.message = mock_message
-        mock_response = Mock()
-        mock_response.choices = [mock_choice]
-        mock_response.usage = OpenAIUsage(100, 40)
-        mock_client.chat = Mock()
-        mock_client.chat.completions = Mock()
-        mock_client.chat.completions.create = Mock(return_value=mock_response)
-
-        with patch.object(step2_module, 'OpenAI', return_value=mock_client):
-            result = step2_main(
-                context_payload={
-                    "proceed": True,
-                    "chatbot": {
-                        "id": "test",
-                        "model_name": "gpt-4o",
-                        "system_prompt": "Test",
-                        "persona": "",
-                        "temperature": 0.7,
-                        "rag_config": {"enabled": False}
-                    },
-                    "user": {"id": "test", "phone": "123", "name": "Test", "variables": {}},
-                    "history": [
-                        {"role": "user", "content": "First message"},
-                        {"role": "assistant", "content": ""},  # Empty content - should be skipped
-                        {"role": "user", "content": "Second message"}
-                    ],
-                    "tools": []
-                },
-                user_message="Current message",
-                openai_api_key="fake_key"
-            )
-
-            # Verify the call was made
-            assert mock_client.chat.completions.create.called
-            call_args = mock_client.chat.completions.create.call_args
-            messages = call_args.kwargs['messages']
+        openai_client.chat.completions.create.return_value = openai_response("Response", OpenAIUsage(100, 40))
 
-            # Should have: system + 2 history messages (skipping empty) + current user message
-            assert len(messages) == 4
-            assert messages[0]['role'] == 'system'
-            assert messages[1]['content'] == 'First message'
-            assert messages[2]['content'] == 'Second message'
-            assert messages[3]['content'] == 'Current message'
+        context_payload["chatbot"]["model_name"] = "gpt-4o"
+        context_payload["history"] = [
+            {"role": "user", "content": "First message"},
+            {"role": "assistant", "content": ""},  # Empty content - should be skipped
+            {"role": "user", "content": "Second message"}
+        ]
 
-    def test_missing_google_api_key(self):
-        """
-        GOAL: Test handling when Google API key is missing
-        GIVEN: Google provider with no API key
-        WHEN: main is called
-        THEN: Returns error for missing API key
-        """
         result = step2_main(
-            context_payload={
-                "proceed": True,
-                "chatbot": {
-                    "id": "test",
-                    "model_name": "gemini-pro",
-                    "system_prompt": "Test",
-                    "persona": "",
-                    "temperature": 0.7,
-                    "rag_config": {"enabled": False}
-                },
-                "user": {"id": "test", "phone": "123", "name": "Test", "variables": {}},
-                "history": [],
-                "tools": []
-            },
-            user_message="Test",
-            google_api_key="",  # Missing
-            default_provider="google"
+            context_payload=context_payload,
+            user_message="Current message",
+            openai_api_key="fake_key"
         )
 
-        assert result["error"] == "Missing Google API Key"
+        # Verify the call was made
+        assert openai_client.chat.completions.create.called
+        call_args = openai_client.chat.completions.create.call_args
+        messages = call_args.kwargs['messages']
 
-    def test_google_no_usage_metadata_fallback(self):
+        # Should have: system + 2 history messages (skipping empty) + current user message
+        assert len(messages) == 4
+        assert messages[0]['role'] == 'system'
+        assert messages[1]['content'] == 'First message'
+        assert messages[2]['content'] == 'Second message'
+        assert messages[3]['content'] == 'Current message'
+
+    def test_google_no_usage_metadata_fallback(self, step2_main, gemini_client, context_payload):
         """
         GOAL: Test Google token estimation fallback when usage_metadata is missing
         GIVEN: Gemini response without usage_metadata
         WHEN: main processes the response
         THEN: Uses estimate_tokens fallback
         """
-        mock_client = Mock()
-        mock_models = Mock()
-        mock_response = Mock()
-        mock_response.text = "Response text"
         # No usage_metadata attribute
-        del mock_response.usage_metadata
-
-        mock_models.generate_content = Mock(return_value=mock_response)
-        mock_client.models = mock_models
-
-        with patch.object(mock_genai, 'Client', return_value=mock_client):
-            result = step2_main(
-                context_payload={
-                    "proceed": True,
-                    "chatbot": {
-                        "id": "test",
-                        "model_name": "gemini-pro",
-                        "system_prompt": "Test",
-                        "persona": "",
-                        "temperature": 0.7,
-                        "rag_config": {"enabled": False}
-                    },
-                    "user": {"id": "test", "phone": "123", "name": "Test", "variables": {}},
-                    "history": [],
-                    "tools": []
-                },
-                user_message="Test",
-                google_api_key="fake_key"
-            )
+        gemini_client.models.generate_content.return_value = SimpleNamespace(text="Response text")
 
-            # Should use estimate_tokens
-            assert result["usage_info"]["tokens_input"] > 0
-            assert result["usage_info"]["tokens_output"] > 0
+        result = step2_main(
+            context_payload=context_payload,
+            user_message="Test",
+            google_api_key="fake_key"
+        )
+
+        # Should use estimate_tokens
+        assert result["usage_info"]["tokens_input"] > 0
+        assert result["usage_info"]["tokens_output"] > 0
 
-    def test_unknown_provider_error(self):
+    def test_unknown_provider_error(self, step2_main, context_payload, no_model_fallback):
         """
         GOAL: Test error handling for unknown provider
         GIVEN: Invalid provider name
         WHEN: main is called
-        THEN: Returns error for unknown provider
+        THEN: Returns the all-failed reply with the unknown provider error in usage_info
         """
+        context_payload["chatbot"]["model_name"] = "unknown-model"
+
         result = step2_main(
-            context_payload={
-                "proceed": True,
-                "chatbot": {
-                    "id": "test",
-                    "model_name": "unknown-model",
-                    "system_prompt": "Test",
-                    "persona": "",
-                    "temperature": 0.7,
-                    "rag_config": {"enabled": False}
-                },
-                "user": {"id": "test", "phone": "123", "name": "Test", "variables": {}},
-                "history": [],
-                "tools": []
-            },
+            context_payload=context_payload,
             user_message="Test",
             default_provider="unknown_provider"
         )
 
-        assert "error" in result
-        assert "unknown_provider" in result["error"].lower()
+        assert_usage(result, provider="failed", model="all_failed",
+                     error="Unknown provider: unknown_provider", is_limit_error=False)
 
 
 class TestAgentLoop:
     """Test agent loop functionality for both OpenAI and Gemini"""
 
-    def test_openai_agent_loop_with_tool_calls(self):
+    def test_openai_agent_loop_with_tool_calls(self, monkeypatch, step2_module):
         """
         GOAL: Test OpenAI agent loop executes tools and returns response
         GIVEN: OpenAI client that returns tool calls then final response
         WHEN: execute_agent_loop_openai is called
         THEN: Tools are executed and final response is returned
         """
-        mock_client = Mock()
-
         # First response: tool call
-        mock_tool_call = Mock()
-        mock_tool_call.id = "call_123"
-        mock_tool_call.function.name = "search_knowledge_base"
-        mock_tool_call.function.arguments = '{"query": "test query"}'
-
-        mock_message_1 = Mock()
-        mock_message_1.tool_calls = [mock_tool_call]
-        mock_choice_1 = Mock()
-        mock_choice_1.finish_reason = "tool_calls"
-        mock_choice_1.message = mock_message_1
-        mock_response_1 = Mock()
-        mock_response_1.choices = [mock_choice_1]
-        mock_response_1.usage = OpenAIUsage(100, 20)
+        mock_tool_call = openai_tool_call("call_123", "search_knowledge_base", '{"query": "test query"}')
+        mock_response_1 = openai_response(
+            None, OpenAIUsage(100, 20), finish_reason="tool_calls", tool_calls=[mock_tool_call]
+        )
 
         # Second response: final answer
-        mock_message_2 = Mock()
-        mock_message_2.content = "Based on the search results, here is the answer."
-        mock_choice_2 = Mock()
-        mock_choice_2.finish_reason = "stop"
-        mock_choice_2.message = mock_message_2
-        mock_response_2 = Mock()
-        mock_response_2.choices = [mock_choice_2]
-        mock_response_2.usage = OpenAIUsage(120, 30)
+        mock_response_2 = openai_response(
+            "Based on the search results, here is the answer.", OpenAIUsage(120, 30)
+        )
 
-        mock_client.chat.completions.create = Mock(side_effect=[mock_response_1, mock_response_2])
+        mock_client = openai_stub(returning(mock_response_1, mock_response_2))
 
         # Mock RAG search
-        with patch.object(step2_module, 'execute_tool') as mock_execute_tool:
-            mock_execute_tool.return_value = {"success": True, "results": [{"content": "info"}]}
-
-            result = step2_module.execute_agent_loop_openai(
-                client=mock_client,
-                model_name="gpt-4o",
-                messages=[{"role": "system", "content": "You are helpful"}],
-                tools=[{
-                    "type": "function",
-                    "function": {
-                        "name": "search_knowledge_base",
-                        "description": "Search knowledge base"
-                    }
-                }],
-                chatbot_id="chatbot-123",
-                temperature=0.7,
-                openai_api_key="fake_key",
-                db_resource="f/development/db",
-                max_iterations=5
-            )
+        mock_execute_tool = MagicMock()
+        monkeypatch.setattr(step2_module, 'execute_tool', mock_execute_tool)
+        mock_execute_tool.return_value = {"success": True, "results": [{"content": "info"}]}
+
+        result = step2_module.execute_agent_loop_openai(
+            client=mock_client,
+            model_name="gpt-4o",
+            messages=[{"role": "system", "content": "You are helpful"}],
+            tools=[{
+                "type": "function",
+                "function": {
+                    "name": "search_knowledge_base",
+                    "description": "Search knowledge base"
+                }
+            }],
+            chatbot_id="chatbot-123",
+            temperature=0.7,
+            openai_api_key="fake_key",
+            db_resource="f/development/db",
+            max_iterations=5
+        )
 
-            # Assertions
-            assert result["reply_text"] == "Based on the search results, here is the answer."
-            assert len(result["tool_executions"]) == 1
-            assert result["tool_executions"][0]["tool_name"] == "search_knowledge_base"
-            assert result["tool_executions"][0]["status"] == "success"
-            assert result["usage_info"]["tokens_input"] == 220  # 100 + 120
-            assert result["usage_info"]["tokens_output"] == 50  # 20 + 30
-            assert result["usage_info"]["iterations"] == 2
+        # Assertions
+        assert result["reply_text"] == "Based on the search results, here is the answer."
+        assert len(result["tool_executions"]) == 1
+        assert result["tool_executions"][0]["tool_name"] == "search_knowledge_base"
+        assert result["tool_executions"][0]["status"] == "success"
+        assert_usage(
+            result,
+            tokens_input=220,  # 100 + 120
+            tokens_output=50,  # 20 + 30
+            tokens_cached=0,  # No prompt_tokens_details reported
+            iterations=2
+        )
 
-    def test_openai_agent_loop_multiple_tool_calls_in_one_response(self):
+    def test_openai_agent_loop_multiple_tool_calls_in_one_response(self, monkeypatch, step2_module):
         """
         GOAL: Test OpenAI agent handles multiple tool calls in single response
         GIVEN: OpenAI response with multiple tool calls
         WHEN: execute_agent_loop_openai processes them
         THEN: All tools are executed and results fed back
         """
-        mock_client = Mock()
-
         # Response with 2 tool calls
-        mock_tool_call_1 = Mock()
-        mock_tool_call_1.id = "call_1"
-        mock_tool_call_1.function.name = "search_knowledge_base"
-        mock_tool_call_1.function.arguments = '{"query": "query1"}'
-
-        mock_tool_call_2 = Mock()
-        mock_tool_call_2.id = "call_2"
-        mock_tool_call_2.function.name = "search_knowledge_base"
-        mock_tool_call_2.function.arguments = '{"query": "query2"}'
-
-        mock_message_1 = Mock()
-        mock_message_1.tool_calls = [mock_tool_call_1, mock_tool_call_2]
-        mock_choice_1 = Mock()
-        mock_choice_1.finish_reason = "tool_calls"
-        mock_choice_1.message = mock_message_1
-        mock_response_1 = Mock()
-        mock_response_1.choices = [mock_choice_1]
-        mock_response_1.usage = OpenAIUsage(100, 20)
+        mock_response_1 = openai_response(
+            None, OpenAIUsage(100, 20), finish_reason="tool_calls", tool_calls=[
+                openai_tool_call("call_1", "search_knowledge_base", '{"query": "query1"}'),
+                openai_tool_call("call_2", "search_knowledge_base", '{"query": "query2"}')
+            ]
+        )
 
         # Final response
-        mock_message_2 = Mock()
-        mock_message_2.content = "Combined answer from both searches"
-        mock_choice_2 = Mock()
-        mock_choice_2.finish_reason = "stop"
-        mock_choice_2.message = mock_message_2
-        mock_response_2 = Mock()
-        mock_response_2.choices = [mock_choice_2]
-        mock_response_2.usage = OpenAIUsage(150, 40)
-
-        mock_client.chat.completions.create = Mock(side_effect=[mock_response_1, mock_response_2])
-
-        with patch.object(step2_module, 'execute_tool') as mock_execute_tool:
-            mock_execute_tool.return_value = {"success": True, "results": []}
-
-            result = step2_module.execute_agent_loop_openai(
-                client=mock_client,
-                model_name="gpt-4o",
-                messages=[{"role": "user", "content": "Test"}],
-                tools=[{"type": "function", "function": {"name": "search_knowledge_base"}}],
-                chatbot_id="chatbot-123",
-                temperature=0.7,
-                openai_api_key="fake_key",
-                db_resource="f/development/db",
-                max_iterations=5
-            )
+        mock_response_2 = openai_response("Combined answer from both searches", OpenAIUsage(150, 40))
+
+        mock_client = openai_stub(returning(mock_response_1, mock_response_2))
 
-            # Should have executed both tools
-            assert len(result["tool_executions"]) == 2
-            assert mock_execute_tool.call_count == 2
+        mock_execute_tool = MagicMock()
+        monkeypatch.setattr(step2_module, 'execute_tool', mock_execute_tool)
+        mock_execute_tool.return_value = {"success": True, "results": []}
 
-    def test_openai_agent_loop_max_iterations(self):
+        result = step2_module.execute_agent_loop_openai(
+            client=mock_client,
+            model_name="gpt-4o",
+            messages=[{"role": "user", "content": "Test"}],
+            tools=[{"type": "function", "function": {"name": "search_knowledge_base"}}],
+            chatbot_id="chatbot-123",
+            temperature=0.7,
+            openai_api_key="fake_key",
+            db_resource="f/development/db",
+            max_iterations=5
+        )
+
+        # Should have executed both tools
+        assert len(result["tool_executions"]) == 2
+        assert mock_execute_tool.call_count == 2
+
+    def test_openai_agent_loop_max_iterations(self, monkeypatch, step2_module):
         """
         GOAL: Test OpenAI agent loop stops at max iterations
         GIVEN: Agent that keeps requesting tools
         WHEN: Max iterations is reached
         THEN: Returns max iterations message
         """
-        mock_client = Mock()
-
         # Always return tool calls
-        mock_tool_call = Mock()
-        mock_tool_call.id = "call_123"
-        mock_tool_call.function.name = "search_knowledge_base"
-        mock_tool_call.function.arguments = '{"query": "test"}'
-
-        mock_message = Mock()
-        mock_message.tool_calls = [mock_tool_call]
-        mock_choice = Mock()
-        mock_choice.finish_reason = "tool_calls"
-        mock_choice.message = mock_message
-        mock_response = Mock()
-        mock_response.choices = [mock_choice]
-        mock_response.usage = OpenAIUsage(100, 20)
-
-        mock_client.chat.completions.create = Mock(return_value=mock_response)
-
-        with patch.object(step2_module, 'execute_tool') as mock_execute_tool:
-            mock_execute_tool.return_value = {"success": True, "results": []}
-
-            result = step2_module.execute_agent_loop_openai(
-                client=mock_client,
-                model_name="gpt-4o",
-                messages=[{"role": "user", "content": "Test"}],
-                tools=[{"type": "function", "function": {"name": "search_knowledge_base"}}],
-                chatbot_id="chatbot-123",
-                temperature=0.7,
-                openai_api_key="fake_key",
-                db_resource="f/development/db",
-                max_iterations=3  # Low limit
-            )
+        mock_tool_call = openai_tool_call("call_123", "search_knowledge_base", '{"query": "test"}')
+        mock_response = openai_response(
+            None, OpenAIUsage(100, 20), finish_reason="tool_calls", tool_calls=[mock_tool_call]
+        )
+
+        mock_client = openai_stub(lambda *args, **kwargs: mock_response)
 
-            # Should hit max iterations
-            assert "need more time" in result["reply_text"].lower() or "rephrase" in result["reply_text"].lower()
-            assert result["usage_info"]["max_iterations_reached"] is True
-            assert result["usage_info"]["iterations"] == 3
+        mock_execute_tool = MagicMock()
+        monkeypatch.setattr(step2_module, 'execute_tool', mock_execute_tool)
+        mock_execute_tool.return_value = {"success": True, "results": []}
 
-    def test_openai_agent_loop_unexpected_finish_reason(self):
+        result = step2_module.execute_agent_loop_openai(
+            client=mock_client,
+            model_name="gpt-4o",
+            messages=[{"role": "user", "content": "Test"}],
+            tools=[{"type": "function", "function": {"name": "search_knowledge_base"}}],
+            chatbot_id="chatbot-123",
+            temperature=0.7,
+            openai_api_key="fake_key",
+            db_resource="f/development/db",
+            max_iterations=3  # Low limit
+        )
+
+        # Should hit max iterations
+        assert "need more time" in result["reply_text"].lower() or "rephrase" in result["reply_text"].lower()
+        assert result["usage_info"]["max_iterations_reached"] is True
+        assert result["usage_info"]["iterations"] == 3
+
+    def test_openai_agent_loop_unexpected_finish_reason(self, step2_module):
         """
         GOAL: Test handling of unexpected finish_reason
         GIVEN: OpenAI returns unexpected finish_reason
         WHEN: execute_agent_loop_openai processes it
         THEN: Returns appropriate error message
         """
-        mock_client = Mock()
-
-        mock_message = Mock()
-        mock_message.content = "Partial response"
-        mock_choice = Mock()
-        mock_choice.finish_reason = "length"  # Unexpected
-        mock_choice.message = mock_message
-        mock_response = Mock()
-        mock_response.choices = [mock_choice]
-        mock_response.usage = OpenAIUsage(100, 20)
+        mock_response = openai_response(
+            "Partial response", OpenAIUsage(100, 20), finish_reason="length"  # Unexpected
+        )
 
-        mock_client.chat.completions.create = Mock(return_value=mock_response)
+        mock_client = openai_stub(lambda *args, **kwargs: mock_response)
 
         result = step2_module.execute_agent_loop_openai(
             client=mock_client,
@@ -879,15 +677,14 @@ class TestAgentLoop:
         assert result["usage_info"]["finish_reason"] == "length"
         assert result["reply_text"] is not None
 
-    def test_openai_agent_loop_exception_handling(self):
+    def test_openai_agent_loop_exception_handling(self, step2_module):
         """
         GOAL: Test OpenAI agent loop handles exceptions gracefully
         GIVEN: OpenAI client that raises exception
         WHEN: execute_agent_loop_openai is called
         THEN: Returns error message with exception info
         """
-        mock_client = Mock()
-        mock_client.chat.completions.create = Mock(side_effect=Exception("API Error"))
+        mock_client = openai_stub(raising(Exception("API Error")))
 
         result = step2_module.execute_agent_loop_openai(
             client=mock_client,
@@ -905,163 +702,115 @@ class TestAgentLoop:
         assert result["usage_info"]["error"] == "API Error"
         assert result["usage_info"]["iterations"] == 1
 
-    def test_openai_agent_loop_via_main(self):
+    def test_openai_agent_loop_via_main(self, step2_main, openai_client, context_payload):
         """
         GOAL: Test OpenAI agent loop is invoked via main when tools are present
         GIVEN: OpenAI chatbot with tools configured
         WHEN: main is called
         THEN: Agent loop is used and tools are available
         """
-        mock_client = Mock()
-
         # Mock agent loop response
-        mock_message = Mock()
-        mock_message.content = "Response using tools"
-        mock_choice = Mock()
-        mock_choice.finish_reason = "stop"
-        mock_choice.message = mock_message
-        mock_response = Mock()
-        mock_response.choices = [mock_choice]
-        mock_response.usage = OpenAIUsage(100, 30)
-
-        mock_client.chat.completions.create = Mock(return_value=mock_response)
-
-        with patch.object(step2_module, 'OpenAI', return_value=mock_client):
-            result = step2_main(
-                context_payload={
-                    "proceed": True,
-                    "chatbot": {
-                        "id": "chatbot-123",
-                        "model_name": "gpt-4o",
-                        "system_prompt": "Test",
-                        "persona": "",
-                        "temperature": 0.7,
-                        "rag_config": {"enabled": False}
-                    },
-                    "user": {"id": "test", "phone": "123", "name": "Test", "variables": {}},
-                    "history": [],
-                    "tools": [
-                        {
-                            "enabled": True,
-                            "provider": "mcp",
-                            "name": "test_tool",
-                            "config": {
-                                "description": "Test tool",
-                                "parameters": {}
-                            }
-                        }
-                    ]
-                },
-                user_message="Test",
-                openai_api_key="fake_key"
-            )
+        openai_client.chat.completions.create.return_value = openai_response(
+            "Response using tools", OpenAIUsage(100, 30)
+        )
 
-            assert "error" not in result
-            assert result["reply_text"] == "Response using tools"
+        context_payload["chatbot"].update({"id": "chatbot-123", "model_name": "gpt-4o"})
+        context_payload["tools"] = [
+            {
+                "enabled": True,
+                "provider": "mcp",
+                "name": "test_tool",
+                "config": {
+                    "description": "Test tool",
+                    "parameters": {}
+                }
+            }
+        ]
 
-    def test_gemini_agent_loop_max_iterations(self):
+        result = step2_main(
+            context_payload=context_payload,
+            user_message="Test",
+            openai_api_key="fake_key"
+        )
+
+        assert "error" not in result
+        assert result["reply_text"] == "Response using tools"
+
+    def test_gemini_agent_loop_max_iterations(self, monkeypatch, step2_module):
         """
         GOAL: Test Gemini agent loop stops at max iterations
         GIVEN: Gemini that keeps requesting function calls
         WHEN: Max iterations is reached
         THEN: Returns max iterations message
         """
-        mock_client = Mock()
-        mock_models = Mock()
-
         # Create function call part
-        mock_fc = Mock()
-        mock_fc.name = "search_knowledge_base"
-        mock_fc.args = {"query": "test"}
-
-        mock_part = Mock()
-        mock_part.function_call = mock_fc
-
-        mock_candidate = Mock()
-        mock_candidate.content = Mock()
-        mock_candidate.content.parts = [mock_part]
-
-        mock_response = Mock()
-        mock_response.candidates = [mock_candidate]
-        mock_response.usage_metadata = UsageMetadata(100, 20)
-
-        mock_models.generate_content = Mock(return_value=mock_response)
-        mock_client.models = mock_models
-
-        with patch.object(step2_module, 'execute_tool') as mock_execute_tool:
-            mock_execute_tool.return_value = {"success": True}
-
-            result = step2_module.execute_agent_loop_gemini(
-                client=mock_client,
-                model_name="gemini-pro",
-                system_prompt="Test",
-                user_message="Test",
-                chat_history=[],
-                tools=[{"function": {"name": "search_knowledge_base"}}],
-                chatbot_id="chatbot-123",
-                temperature=0.7,
-                google_api_key="fake_key",
-                db_resource="f/development/db",
-                fallback_message_error="Error",
-                fallback_message_limit="Limit",
-                max_iterations=2
-            )
+        mock_fc = SimpleNamespace(name="search_knowledge_base", args={"query": "test"})
+        mock_part = SimpleNamespace(function_call=mock_fc)
 
-            # Should hit max iterations
-            assert "reformular" in result["reply_text"].lower() or "información" in result["reply_text"].lower()
-            assert result["usage_info"]["max_iterations_reached"] is True
+        mock_response = SimpleNamespace(
+            candidates=[SimpleNamespace(content=SimpleNamespace(parts=[mock_part]))],
+            usage_metadata=UsageMetadata(100, 20)
+        )
+
+        mock_client = gemini_stub(lambda *args, **kwargs: mock_response)
+
+        mock_execute_tool = MagicMock()
+        monkeypatch.setattr(step2_module, 'execute_tool', mock_execute_tool)
+        mock_execute_tool.return_value = {"success": True}
+
+        result = step2_module.execute_agent_loop_gemini(
+            client=mock_client,
+            model_name="gemini-pro",
+            system_prompt="Test",
+            user_message="Test",
+            chat_history=[],
+            tools=[{"function": {"name": "search_knowledge_base"}}],
+            chatbot_id="chatbot-123",
+            temperature=0.7,
+            google_api_key="fake_key",
+            db_resource="f/development/db",
+            fallback_message_error="Error",
+            fallback_message_limit="Limit",
+            max_iterations=2
+        )
+
+        # Should hit max iterations
+        assert "reformular" in result["reply_text"].lower() or "información" in result["reply_text"].lower()
+        assert result["usage_info"]["max_iterations_reached"] is True
 
 
 class TestToolExecution:
     """Test tool execution functionality"""
 
-    def test_execute_tool_search_knowledge_base(self):
+    def test_execute_tool_search_knowledge_base(self, monkeypatch, step2_module):
         """
         GOAL: Test built-in search_knowledge_base tool execution
         GIVEN: Tool call to search_knowledge_base
         WHEN: execute_tool is called
         THEN: RAG search is executed
         """
-        with patch.object(step2_module, 'execute_rag_search') as mock_rag_search:
-            mock_rag_search.return_value = {"success": True, "results": []}
+        mock_rag_search = MagicMock()
+        monkeypatch.setattr(step2_module, 'execute_rag_search', mock_rag_search)
+        mock_rag_search.return_value = {"success": True, "results": []}
 
-            result = step2_module.execute_tool(
-                tool_name="search_knowledge_base",
-                arguments={"query": "test query"},
-                tools=[],  # Not in tools list - it's built-in
-                chatbot_id="chatbot-123",
-                openai_api_key="fake_key",
-                db_resource="f/development/db"
-            )
-
-            assert result["success"] is True
-            mock_rag_search.assert_called_once_with(
-                chatbot_id="chatbot-123",
-                query="test query",
-                openai_api_key="fake_key",
-                db_resource="f/development/db"
-            )
-
-    def test_execute_tool_not_found(self):
-        """
-        GOAL: Test error when tool is not found
-        GIVEN: Invalid tool name
-        WHEN: execute_tool is called
-        THEN: Returns tool not found error
-        """
         result = step2_module.execute_tool(
-            tool_name="nonexistent_tool",
-            arguments={},
-            tools=[],
+            tool_name="search_knowledge_base",
+            arguments={"query": "test query"},
+            tools=[],  # Not in tools list - it's built-in
             chatbot_id="chatbot-123",
             openai_api_key="fake_key",
             db_resource="f/development/db"
         )
 
-        assert "error" in result
-        assert "not found" in result["error"].lower()
+        assert result["success"] is True
+        mock_rag_search.assert_called_once_with(
+            chatbot_id="chatbot-123",
+            query="test query",
+            openai_api_key="fake_key",
+            db_resource="f/development/db"
+        )
 
-    def test_execute_tool_mcp(self):
+    def test_execute_tool_mcp(self, monkeypatch, step2_module):
         """
         GOAL: Test MCP tool execution
         GIVEN: MCP tool definition
@@ -1077,22 +826,23 @@ class TestToolExecution:
             }
         }]
 
-        with patch.object(step2_module, 'execute_mcp_tool') as mock_mcp:
-            mock_mcp.return_value = {"result": "calculated"}
+        mcp_calls = []
+        monkeypatch.setattr(step2_module, 'execute_mcp_tool',
+                            recording(mcp_calls, {"result": "calculated"}))
 
-            result = step2_module.execute_tool(
-                tool_name="calculate_price",
-                arguments={"amount": 100},
-                tools=tools,
-                chatbot_id="chatbot-123",
-                openai_api_key="fake_key",
-                db_resource="f/development/db"
-            )
+        result = step2_module.execute_tool(
+            tool_name="calculate_price",
+            arguments={"amount": 100},
+            tools=tools,
+            chatbot_id="chatbot-123",
+            openai_api_key="fake_key",
+            db_resource="f/development/db"
+        )
 
-            assert result["result"] == "calculated"
-            mock_mcp.assert_called_once()
+        assert result["result"] == "calculated"
+        assert len(mcp_calls) == 1
 
-    def test_execute_tool_windmill(self):
+    def test_execute_tool_windmill(self, monkeypatch, step2_module):
         """
         GOAL: Test Windmill tool execution
         GIVEN: Windmill tool definition
@@ -1108,33 +858,45 @@ class TestToolExecution:
             }
         }]
 
-        with patch.object(step2_module, 'execute_windmill_tool') as mock_windmill:
-            mock_windmill.return_value = {"success": True, "data": "processed"}
-
-            result = step2_module.execute_tool(
-                tool_name="process_data",
-                arguments={"input": "data"},
-                tools=tools,
-                chatbot_id="chatbot-123",
-                openai_api_key="fake_key",
-                db_resource="f/development/db"
-            )
+        windmill_calls = []
+        monkeypatch.setattr(step2_module, 'execute_windmill_tool',
+                            recording(windmill_calls, {"success": True, "data": "processed"}))
 
-            assert result["success"] is True
-            mock_windmill.assert_called_once()
+        result = step2_module.execute_tool(
+            tool_name="process_data",
+            arguments={"input": "data"},
+            tools=tools,
+            chatbot_id="chatbot-123",
+            openai_api_key="fake_key",
+            db_resource="f/development/db"
+        )
 
-    def test_execute_tool_unknown_type(self):
-        """
-        GOAL: Test error for unknown tool type
-        GIVEN: Tool with unknown type
-        WHEN: execute_tool is called
-        THEN: Returns unknown tool type error
-        """
-        tools = [{
-            "type": "function",
-            "function": {"name": "test_tool"},
-            "_metadata": {"tool_type": "unknown"}
-        }]
+        assert result["success"] is True
+        assert len(windmill_calls) == 1
+
+    @pytest.mark.parametrize("tools,mcp_error,expected", [
+        pytest.param([], None, "not found", id="not_found"),
+        pytest.param(
+            [{
+                "type": "function",
+                "function": {"name": "test_tool"},
+                "_metadata": {"tool_type": "unknown"}
+            }],
+            None, "unknown tool type", id="unknown_type"
+        ),
+        pytest.param(
+            [{
+                "type": "function",
+                "function": {"name": "test_tool"},
+                "_metadata": {"tool_type": "mcp", "mcp_server_url": "http://server"}
+            }],
+            Exception("Tool failed"), "tool failed", id="exception"
+        ),
+    ])
+    def test_execute_tool_errors(self, monkeypatch, step2_module, tools, mcp_error, expected):
+        """Test execute_tool errors: unknown name, unknown type and exceptions from the executor"""
+        if mcp_error is not None:
+            monkeypatch.setattr(step2_module, 'execute_mcp_tool', raising(mcp_error))
 
         result = step2_module.execute_tool(
             tool_name="test_tool",
@@ -1146,135 +908,176 @@ class TestToolExecution:
         )
 
         assert "error" in result
-        assert "unknown tool type" in result["error"].lower()
-
-    def test_execute_tool_exception(self):
-        """
-        GOAL: Test exception handling in tool execution
-        GIVEN: Tool that raises exception
-        WHEN: execute_tool is called
-        THEN: Returns error message
-        """
-        tools = [{
-            "type": "function",
-            "function": {"name": "failing_tool"},
-            "_metadata": {"tool_type": "mcp", "mcp_server_url": "http://server"}
-        }]
-
-        with patch.object(step2_module, 'execute_mcp_tool') as mock_mcp:
-            mock_mcp.side_effect = Exception("Tool failed")
-
-            result = step2_module.execute_tool(
-                tool_name="failing_tool",
-                arguments={},
-                tools=tools,
-                chatbot_id="chatbot-123",
-                openai_api_key="fake_key",
-                db_resource="f/development/db"
-            )
-
-            assert "error" in result
-            assert "Tool failed" in result["error"]
+        assert expected in result["error"].lower()
 
 
 class TestRAGSearch:
     """Test RAG search execution"""
 
-    def test_execute_rag_search_success(self):
+    def test_execute_rag_search_success(self, step2_module, table_retrieve):
         """
         GOAL: Test successful RAG search execution
         GIVEN: Valid search parameters
         WHEN: execute_rag_search is called
         THEN: Returns formatted search results
         """
-        with patch.object(step2_module, 'retrieve_knowledge') as mock_retrieve:
-            mock_retrieve.return_value = [
-                {
-                    "content": "Information about product",
-                    "source_name": "Manual",
-                    "similarity": 0.9,
-                    "metadata": {"page": 10}
-                }
-            ]
-
-            result = step2_module.execute_rag_search(
-                chatbot_id="chatbot-123",
-                query="product info",
-                openai_api_key="fake_key",
-                db_resource="f/development/db"
-            )
+        result = step2_module.execute_rag_search(
+            chatbot_id="chatbot-123",
+            query="product info",
+            openai_api_key="fake_key",
+            db_resource="f/development/db"
+        )
 
-            assert result["success"] is True
-            assert len(result["results"]) == 1
-            assert result["results"][0]["content"] == "Information about product"
-            assert result["results"][0]["relevance"] == "90%"
-            assert result["count"] == 1
+        assert result["success"] is True
+        assert len(result["results"]) == 1
+        assert result["results"][0]["content"] == "Information about product"
+        assert result["results"][0]["relevance"] == "90%"
+        assert result["count"] == 1
 
-    def test_execute_rag_search_no_results(self):
+    def test_execute_rag_search_no_results(self, step2_module, table_retrieve):
         """
         GOAL: Test RAG search with no results
         GIVEN: Search query that returns no results
         WHEN: execute_rag_search is called
         THEN: Returns empty results with message
         """
-        with patch.object(step2_module, 'retrieve_knowledge') as mock_retrieve:
-            mock_retrieve.return_value = []
-
-            result = step2_module.execute_rag_search(
-                chatbot_id="chatbot-123",
-                query="unknown topic",
-                openai_api_key="fake_key",
-                db_resource="f/development/db"
-            )
+        result = step2_module.execute_rag_search(
+            chatbot_id="chatbot-123",
+            query="unknown topic",
+            openai_api_key="fake_key",
+            db_resource="f/development/db"
+        )
 
-            assert result["success"] is True
-            assert len(result["results"]) == 0
-            assert "no relevant information" in result["message"].lower()
+        assert result["success"] is True
+        assert len(result["results"]) == 0
+        assert "no relevant information" in result["message"].lower()
 
-    def test_execute_rag_search_exception(self):
+    def test_execute_rag_search_exception(self, monkeypatch, step2_module):
         """
         GOAL: Test RAG search exception handling
         GIVEN: retrieve_knowledge raises exception
         WHEN: execute_rag_search is called
         THEN: Returns error message
         """
-        with patch.object(step2_module, 'retrieve_knowledge') as mock_retrieve:
-            mock_retrieve.side_effect = Exception("Database error")
+        monkeypatch.setattr(step2_module, 'retrieve_knowledge', raising(Exception("Database error")))
 
-            result = step2_module.execute_rag_search(
-                chatbot_id="chatbot-123",
-                query="test",
-                openai_api_key="fake_key",
-                db_resource="f/development/db"
-            )
+        result = step2_module.execute_rag_search(
+            chatbot_id="chatbot-123",
+            query="test",
+            openai_api_key="fake_key",
+            db_resource="f/development/db"
+        )
 
-            assert "error" in result
-            assert "Database error" in result["error"]
+        assert "error" in result
+        assert "Database error" in result["error"]
 
-    def test_retrieve_knowledge_exception_handling(self):
+    def test_retrieve_knowledge_exception_handling(self, monkeypatch, step2_module):
         """
         GOAL: Test retrieve_knowledge exception handling
         GIVEN: Database or API error during retrieval
         WHEN: retrieve_knowledge is called
         THEN: Returns empty list
         """
-        with patch.object(step2_module, 'OpenAI') as mock_openai:
-            mock_openai.side_effect = Exception("OpenAI error")
+        monkeypatch.setattr(step2_module, 'OpenAI', raising(Exception("OpenAI error")))
+        result = step2_module.retrieve_knowledge(
+            chatbot_id="chatbot-123",
+            query="test",
+            openai_api_key="fake_key",
+            db_resource="f/development/db"
+        )
+
+        assert result == []
 
-            result = step2_module.retrieve_knowledge(
+    def test_retrieve_knowledge_cached(self, monkeypatch, step2_module, openai_client):
+        """Test that a repeated search reuses the cached chunks instead of embedding and querying again"""
+        openai_client.embeddings.create.return_value = SimpleNamespace(
+            data=[SimpleNamespace(embedding=list(FAKE_EMBEDDING))]
+        )
+        # Rows for two searches; the second is only reached after clearing the cache
+        fake_cursor = FakeCursor(fetchall_rows=[[RAG_CHUNK_ROW], [RAG_CHUNK_ROW]])
+        db_connections = []
+
+        @contextmanager
+        def fake_get_db_connection(*args, **kwargs):
+            db_connections.append(args)
+            yield FakeConnection(fake_cursor), fake_cursor
+
+        monkeypatch.setattr(step2_module, 'get_db_connection', fake_get_db_connection)
+
+        search = dict(chatbot_id="chatbot-123", query="product info",
+                      openai_api_key="fake_key", db_resource="f/development/db")
+        first = step2_module.execute_rag_search(**search)
+        second = step2_module.execute_rag_search(**search)
+
+        assert first == second
+        assert first["count"] == 1
+        assert openai_client.embeddings.create.call_count == 1
+        assert len(db_connections) == 1
+
+        # Clearing the cache forces a fresh lookup
+        step2_module._rag_cache_clear()
+        step2_module.execute_rag_search(**search)
+        assert len(db_connections) == 2
+
+    def test_retrieve_knowledge_refresh_at_capacity(self, monkeypatch, step2_module, openai_client):
+        """Test that refreshing an expired entry in a full cache keeps the other entries and itself"""
+        openai_client.embeddings.create.return_value = SimpleNamespace(
+            data=[SimpleNamespace(embedding=list(FAKE_EMBEDDING))]
+        )
+        fake_cursor = FakeCursor(fetchall_rows=[[RAG_CHUNK_ROW]] * 4)
+
+        @contextmanager
+        def fake_get_db_connection(*args, **kwargs):
+            yield FakeConnection(fake_cursor), fake_cursor
+
+        monkeypatch.setattr(step2_module, 'get_db_connection', fake_get_db_connection)
+        monkeypatch.setattr(step2_module, 'RAG_CACHE_MAX_ENTRIES', 2)
+
+        def search(query):
+            return step2_module.retrieve_knowledge(
                 chatbot_id="chatbot-123",
-                query="test",
+                query=query,
                 openai_api_key="fake_key",
                 db_resource="f/development/db"
             )
 
-            assert result == []
+        search("first")
+        search("second")
+        # Expire "second" so the next search refreshes it while the cache is full
+        second_key = list(step2_module._rag_cache)[1]
+        step2_module._rag_cache[second_key] = (float("-inf"), step2_module._rag_cache[second_key][1])
+        search("second")
+
+        assert [key[1] for key in step2_module._rag_cache] == ["first", "second"]
+
+        # A new key now evicts the least recently stored entry, not the refreshed one
+        search("third")
+        assert [key[1] for key in step2_module._rag_cache] == ["second", "third"]
+
+    def test_retrieve_knowledge_error_not_cached(self, monkeypatch, step2_module):
+        """Test that a failed retrieval is attempted again on the next search"""
+        openai_calls = []
+
+        def failing_openai(*args, **kwargs):
+            openai_calls.append(kwargs)
+            raise Exception("OpenAI error")
+
+        monkeypatch.setattr(step2_module, 'OpenAI', failing_openai)
+
+        for _ in range(2):
+            assert step2_module.retrieve_knowledge(
+                chatbot_id="chatbot-123",
+                query="test",
+                openai_api_key="fake_key",
+                db_resource="f/development/db"
+            ) == []
+        assert len(openai_calls) == 2
 
 
 class TestMCPToolExecution:
     """Test MCP tool execution"""
 
-    def test_execute_mcp_tool_success(self):
+    def test_execute_mcp_tool_success(self, step2_module, http_stub):
         """
         GOAL: Test successful MCP tool execution
         GIVEN: Valid MCP server and tool
@@ -1286,32 +1089,31 @@ class TestMCPToolExecution:
             "integration_id": "int-123"
         }
 
-        with patch('requests.post') as mock_post:
-            mock_response = Mock()
-            mock_response.json.return_value = {"result": "success"}
-            mock_post.return_value = mock_response
-
-            result = step2_module.execute_mcp_tool(
-                tool_name="calculate_price",
-                metadata=metadata,
-                arguments={"amount": 100},
-                chatbot_id="chatbot-123"
-            )
-
-            assert result["result"] == "success"
-            mock_post.assert_called_once()
-            call_args = mock_post.call_args
-            assert call_args.kwargs['json']['chatbot_id'] == "chatbot-123"
-            assert call_args.kwargs['json']['amount'] == 100
+        result = step2_module.execute_mcp_tool(
+            tool_name="calculate_price",
+            metadata=metadata,
+            arguments={"amount": 100},
+            chatbot_id="chatbot-123"
+        )
 
-    def test_execute_mcp_tool_no_url(self):
-        """
-        GOAL: Test MCP tool execution with missing URL
-        GIVEN: Metadata without server URL
-        WHEN: execute_mcp_tool is called
-        THEN: Returns error for missing URL
-        """
-        metadata = {}  # No URL
+        assert result["result"] == "success"
+        assert len(http_stub.calls) == 1
+        _, post_kwargs = http_stub.calls[0]
+        assert post_kwargs['json']['chatbot_id'] == "chatbot-123"
+        assert post_kwargs['json']['amount'] == 100
+
+    @pytest.mark.parametrize("metadata,post_error,expected", [
+        pytest.param({}, None, "not configured", id="no_url"),
+        pytest.param({"mcp_server_url": "http://mcp-server:3001"}, requests.Timeout(), "timeout",
+                     id="timeout"),
+        pytest.param({"mcp_server_url": "http://mcp-server:3001"},
+                     requests.RequestException("Connection error"), "connection error",
+                     id="request_exception"),
+    ])
+    def test_execute_mcp_tool_errors(self, monkeypatch, step2_module, metadata, post_error, expected):
+        """Test MCP tool errors: missing URL, timeout and request failures come back as an error dict"""
+        if post_error is not None:
+            monkeypatch.setattr('requests.post', raising(post_error))
 
         result = step2_module.execute_mcp_tool(
             tool_name="test_tool",
@@ -1321,59 +1123,13 @@ class TestMCPToolExecution:
         )
 
         assert "error" in result
-        assert "not configured" in result["error"].lower()
-
-    def test_execute_mcp_tool_timeout(self):
-        """
-        GOAL: Test MCP tool timeout handling
-        GIVEN: MCP server that times out
-        WHEN: execute_mcp_tool is called
-        THEN: Returns timeout error
-        """
-        metadata = {"mcp_server_url": "http://mcp-server:3001"}
-
-        with patch('requests.post') as mock_post:
-            import requests
-            mock_post.side_effect = requests.Timeout()
-
-            result = step2_module.execute_mcp_tool(
-                tool_name="slow_tool",
-                metadata=metadata,
-                arguments={},
-                chatbot_id="chatbot-123"
-            )
-
-            assert "error" in result
-            assert "timeout" in result["error"].lower()
-
-    def test_execute_mcp_tool_request_exception(self):
-        """
-        GOAL: Test MCP tool request exception handling
-        GIVEN: MCP server that returns error
-        WHEN: execute_mcp_tool is called
-        THEN: Returns error message
-        """
-        metadata = {"mcp_server_url": "http://mcp-server:3001"}
-
-        with patch('requests.post') as mock_post:
-            import requests
-            mock_post.side_effect = requests.RequestException("Connection error")
-
-            result = step2_module.execute_mcp_tool(
-                tool_name="failing_tool",
-                metadata=metadata,
-                arguments={},
-                chatbot_id="chatbot-123"
-            )
-
-            assert "error" in result
-            assert "Connection error" in result["error"]
+        assert expected in result["error"].lower()
 
 
 class TestWindmillToolExecution:
     """Test Windmill tool execution"""
 
-    def test_execute_windmill_tool_success(self):
+    def test_execute_windmill_tool_success(self, monkeypatch, step2_module):
         """
         GOAL: Test successful Windmill tool execution
         GIVEN: Valid Windmill script path
@@ -1383,7 +1139,9 @@ class TestWindmillToolExecution:
         metadata = {"script_path": "f/scripts/process_data"}
         arguments = {"input": "test data"}
 
-        mock_wmill.run_script_by_path = Mock(return_value={"processed": "data"})
+        script_calls = []
+        monkeypatch.setattr(step2_module.wmill, 'run_script_by_path',
+                            recording(script_calls, {"processed": "data"}))
 
         result = step2_module.execute_windmill_tool(
             metadata=metadata,
@@ -1392,13 +1150,11 @@ class TestWindmillToolExecution:
 
         assert result["success"] is True
         assert result["data"]["processed"] == "data"
-        mock_wmill.run_script_by_path.assert_called_once_with(
-            path="f/scripts/process_data",
-            args=arguments,
-            timeout=30
-        )
+        assert script_calls == [
+            ((), {"path": "f/scripts/process_data", "args": arguments, "timeout": 30})
+        ]
 
-    def test_execute_windmill_tool_no_script_path(self):
+    def test_execute_windmill_tool_no_script_path(self, step2_module):
         """
         GOAL: Test Windmill tool with missing script path
         GIVEN: Metadata without script_path
@@ -1415,7 +1171,7 @@ class TestWindmillToolExecution:
         assert "error" in result
         assert "not configured" in result["error"].lower()
 
-    def test_execute_windmill_tool_exception(self):
+    def test_execute_windmill_tool_exception(self, monkeypatch, step2_module):
         """
         GOAL: Test Windmill tool exception handling
         GIVEN: Script that raises exception
@@ -1424,7 +1180,7 @@ class TestWindmillToolExecution:
         """
         metadata = {"script_path": "f/scripts/failing"}
 
-        mock_wmill.run_script_by_path = Mock(side_effect=Exception("Script failed"))
+        monkeypatch.setattr(step2_module.wmill, 'run_script_by_path', raising(Exception("Script failed")))
 
         result = step2_module.execute_windmill_tool(
             metadata=metadata,
@@ -1438,7 +1194,7 @@ class TestWindmillToolExecution:
 class TestToolPreparation:
     """Test tool definition preparation"""
 
-    def test_prepare_tool_definitions_disabled_tools(self):
+    def test_prepare_tool_definitions_disabled_tools(self, step2_module):
         """
         GOAL: Test that disabled tools are skipped
         GIVEN: Tool list with enabled and disabled tools
@@ -1465,7 +1221,7 @@ class TestToolPreparation:
         assert len(result) == 1
         assert result[0]["function"]["name"] == "enabled_tool"
 
-    def test_prepare_tool_definitions_windmill_tool(self):
+    def test_prepare_tool_definitions_windmill_tool(self, step2_module):
         """
         GOAL: Test Windmill tool definition preparation
         GIVEN: Windmill tool configuration
@@ -1495,28 +1251,16 @@ class TestToolPreparation:
 class TestUtilityFunctions:
     """Test utility functions"""
 
-    def test_estimate_tokens(self):
-        """
-        GOAL: Test token estimation function
-        GIVEN: Text of various lengths
-        WHEN: estimate_tokens is called
-        THEN: Returns reasonable token estimate
-        """
-        # Short text
-        short_tokens = step2_module.estimate_tokens("Hello world")
-        assert short_tokens > 0
-        assert short_tokens < 10
-
-        # Long text (400 chars = ~100 tokens)
-        long_text = "a" * 400
-        long_tokens = step2_module.estimate_tokens(long_text)
-        assert long_tokens == 100
+    @pytest.mark.parametrize("text,low,high", [
+        pytest.param("Hello world", 1, 9, id="short"),
+        pytest.param("a" * 400, 100, 100, id="long"),  # 400 chars = ~100 tokens
+        pytest.param("", 1, 1, id="empty"),  # never below 1
+    ])
+    def test_estimate_tokens(self, step2_module, text, low, high):
+        """Test token estimation stays within the expected range for the text length"""
+        assert low <= step2_module.estimate_tokens(text) <= high
 
-        # Empty text should return at least 1
-        empty_tokens = step2_module.estimate_tokens("")
-        assert empty_tokens == 1
-
-    def test_build_tool_instructions_with_llm_instructions(self):
+    def test_build_tool_instructions_with_llm_instructions(self, step2_module):
         """
         GOAL: Test build_tool_instructions includes LLM instructions when present
         GIVEN: Tools with llm_instructions field
@@ -1545,28 +1289,21 @@ class TestUtilityFunctions:
         assert "Use this when user asks about pricing" in result
         assert "tool_without_instructions" in result
 
-    def test_step1_failure_handling(self):
+    def test_step1_failure_handling(self, step2_main):
         """
         GOAL: Test proper error handling when Step 1 fails
         GIVEN: context_payload with proceed=False
         WHEN: main is called
         THEN: Returns error message and notify_admin flag
         """
-        result = step2_main(
-            context_payload={
-                "proceed": False,
-                "reason": "User is blocked",
-                "notify_admin": True
-            },
-            user_message="Test"
-        )
+        result = step2_main(context_payload=STEP1_FAILURE_PAYLOAD, user_message="Test")
 
         assert "error" in result
         assert result["error"] == "User is blocked"
         assert result["should_notify_admin"] is True
         assert "unable to process" in result["reply_text"].lower()
 
-    def test_retrieve_knowledge_no_api_key(self):
+    def test_retrieve_knowledge_no_api_key(self, step2_module):
         """
         GOAL: Test retrieve_knowledge returns empty when no API key
         GIVEN: Empty API key
@@ -1582,133 +1319,103 @@ class TestUtilityFunctions:
 
         assert result == []
 
-    def test_openai_agent_loop_json_decode_error(self):
+    def test_openai_agent_loop_json_decode_error(self, monkeypatch, step2_module):
         """
         GOAL: Test handling of malformed JSON in tool call arguments
         GIVEN: Tool call with invalid JSON arguments
         WHEN: execute_agent_loop_openai processes it
         THEN: Handles JSON decode error gracefully
         """
-        mock_client = Mock()
-
         # First response: tool call with malformed JSON
-        mock_tool_call = Mock()
-        mock_tool_call.id = "call_123"
-        mock_tool_call.function.name = "search_knowledge_base"
-        mock_tool_call.function.arguments = '{invalid json}'  # Malformed
-
-        mock_message_1 = Mock()
-        mock_message_1.tool_calls = [mock_tool_call]
-        mock_choice_1 = Mock()
-        mock_choice_1.finish_reason = "tool_calls"
-        mock_choice_1.message = mock_message_1
-        mock_response_1 = Mock()
-        mock_response_1.choices = [mock_choice_1]
-        mock_response_1.usage = OpenAIUsage(100, 20)
+        mock_tool_call = openai_tool_call("call_123", "search_knowledge_base", '{invalid json}')  # Malformed
+        mock_response_1 = openai_response(
+            None, OpenAIUsage(100, 20), finish_reason="tool_calls", tool_calls=[mock_tool_call]
+        )
 
         # Second response: final answer
-        mock_message_2 = Mock()
-        mock_message_2.content = "Here is the answer"
-        mock_choice_2 = Mock()
-        mock_choice_2.finish_reason = "stop"
-        mock_choice_2.message = mock_message_2
-        mock_response_2 = Mock()
-        mock_response_2.choices = [mock_choice_2]
-        mock_response_2.usage = OpenAIUsage(120, 30)
-
-        mock_client.chat.completions.create = Mock(side_effect=[mock_response_1, mock_response_2])
-
-        with patch.object(step2_module, 'execute_tool') as mock_execute_tool:
-            mock_execute_tool.return_value = {"success": True}
-
-            result = step2_module.execute_agent_loop_openai(
-                client=mock_client,
-                model_name="gpt-4o",
-                messages=[{"role": "user", "content": "Test"}],
-                tools=[{"type": "function", "function": {"name": "search_knowledge_base"}}],
-                chatbot_id="chatbot-123",
-                temperature=0.7,
-                openai_api_key="fake_key",
-                db_resource="f/development/db",
-                max_iterations=5
-            )
+        mock_response_2 = openai_response("Here is the answer", OpenAIUsage(120, 30))
+
+        mock_client = openai_stub(returning(mock_response_1, mock_response_2))
+
+        mock_execute_tool = MagicMock()
+        monkeypatch.setattr(step2_module, 'execute_tool', mock_execute_tool)
+        mock_execute_tool.return_value = {"success": True}
+
+        result = step2_module.execute_agent_loop_openai(
+            client=mock_client,
+            model_name="gpt-4o",
+            messages=[{"role": "user", "content": "Test"}],
+            tools=[{"type": "function", "function": {"name": "search_knowledge_base"}}],
+            chatbot_id="chatbot-123",
+            temperature=0.7,
+            openai_api_key="fake_key",
+            db_resource="f/development/db",
+            max_iterations=5
+        )
 
-            # Should have handled the error and continued
-            assert result["reply_text"] == "Here is the answer"
-            # Tool should have been called with empty args
-            mock_execute_tool.assert_called_once()
-            call_args = mock_execute_tool.call_args
-            assert call_args.kwargs['arguments'] == {}
+        # Should have handled the error and continued
+        assert result["reply_text"] == "Here is the answer"
+        # Tool should have been called with empty args
+        mock_execute_tool.assert_called_once()
+        call_args = mock_execute_tool.call_args
+        assert call_args.kwargs['arguments'] == {}
 
-    def test_gemini_agent_loop_with_tool_calls(self):
+    def test_gemini_agent_loop_with_tool_calls(self, monkeypatch, step2_module):
         """
         GOAL: Test Gemini agent loop executes tools and returns final response
         GIVEN: Gemini client that returns function calls then final response
         WHEN: execute_agent_loop_gemini is called
         THEN: Tools are executed and final response is returned
         """
-        mock_client = Mock()
-        mock_models = Mock()
-
         # First response: function call
-        mock_fc = Mock()
-        mock_fc.name = "search_knowledge_base"
-        mock_fc.args = {"query": "test query"}
-
-        mock_part_1 = Mock()
-        mock_part_1.function_call = mock_fc
-
-        mock_candidate_1 = Mock()
-        mock_candidate_1.content = Mock()
-        mock_candidate_1.content.parts = [mock_part_1]
-
-        mock_response_1 = Mock()
-        mock_response_1.candidates = [mock_candidate_1]
-        mock_response_1.usage_metadata = UsageMetadata(100, 20)
-
-        # Second response: final answer (no function calls)
-        mock_part_2 = Mock()
-        # Part without function_call attribute
-        if hasattr(mock_part_2, 'function_call'):
-            delattr(mock_part_2, 'function_call')
-
-        mock_candidate_2 = Mock()
-        mock_candidate_2.content = Mock()
-        mock_candidate_2.content.parts = [mock_part_2]
-
-        mock_response_2 = Mock()
-        mock_response_2.candidates = [mock_candidate_2]
-        mock_response_2.text = "Based on the search, here is the answer"
-        mock_response_2.usage_metadata = UsageMetadata(120, 30)
-
-        mock_models.generate_content = Mock(side_effect=[mock_response_1, mock_response_2])
-        mock_client.models = mock_models
-
-        with patch.object(step2_module, 'execute_tool') as mock_execute_tool:
-            mock_execute_tool.return_value = {"success": True, "results": []}
-
-            result = step2_module.execute_agent_loop_gemini(
-                client=mock_client,
-                model_name="gemini-pro",
-                system_prompt="You are helpful",
-                user_message="Test question",
-                chat_history=[],
-                tools=[{"function": {"name": "search_knowledge_base"}}],
-                chatbot_id="chatbot-123",
-                temperature=0.7,
-                google_api_key="fake_key",
-                db_resource="f/development/db",
-                fallback_message_error="Error",
-                fallback_message_limit="Limit",
-                max_iterations=5
-            )
+        mock_fc = SimpleNamespace(name="search_knowledge_base", args={"query": "test query"})
+        mock_part_1 = SimpleNamespace(function_call=mock_fc)
+
+        mock_response_1 = SimpleNamespace(
+            candidates=[SimpleNamespace(content=SimpleNamespace(parts=[mock_part_1]))],
+            usage_metadata=UsageMetadata(100, 20)
+        )
+
+        # Second response: final answer (part without function_call attribute)
+        mock_part_2 = SimpleNamespace(text="Based on the search, here is the answer")
 
-            # Should have executed tool and returned final answer
-            assert result["reply_text"] == "Based on the search, here is the answer"
-            assert len(result["tool_executions"]) == 1
-            assert result["usage_info"]["tokens_input"] == 220  # 100 + 120
-            assert result["usage_info"]["tokens_output"] == 50  # 20 + 30
-            assert result["usage_info"]["iterations"] == 2
+        mock_response_2 = SimpleNamespace(
+            text="Based on the search, here is the answer",
+            candidates=[SimpleNamespace(content=SimpleNamespace(parts=[mock_part_2]))],
+            usage_metadata=UsageMetadata(120, 30)
+        )
+
+        mock_client = gemini_stub(returning(mock_response_1, mock_response_2))
+
+        mock_execute_tool = MagicMock()
+        monkeypatch.setattr(step2_module, 'execute_tool', mock_execute_tool)
+        mock_execute_tool.return_value = {"success": True, "results": []}
+
+        result = step2_module.execute_agent_loop_gemini(
+            client=mock_client,
+            model_name="gemini-pro",
+            system_prompt="You are helpful",
+            user_message="Test question",
+            chat_history=[],
+            tools=[{"function": {"name": "search_knowledge_base"}}],
+            chatbot_id="chatbot-123",
+            temperature=0.7,
+            google_api_key="fake_key",
+            db_resource="f/development/db",
+            fallback_message_error="Error",
+            fallback_message_limit="Limit",
+            max_iterations=5
+        )
+
+        # Should have executed tool and returned final answer
+        assert result["reply_text"] == "Based on the search, here is the answer"
+        assert len(result["tool_executions"]) == 1
+        assert_usage(
+            result,
+            tokens_input=220,  # 100 + 120
+            tokens_output=50,  # 20 + 30
+            iterations=2
+        )
 
 
 if __name__ == "__main__":
@@ -9,29 +9,17 @@ Tests Step 3a's ability to:
 """
 
 import pytest
-import sys
-import os
-from unittest.mock import Mock, patch, MagicMock
+from unittest.mock import Mock, patch
 
-# Add parent directories to path
-sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../../f/development'))
 
-# Import the module under test
-import importlib.util
-spec = importlib.util.spec_from_file_location(
-    "step3a",
-    os.path.join(os.path.dirname(__file__), '../../f/development/3_1_send_reply_to_whatsapp.py')
-)
-step3a_module = importlib.util.module_from_spec(spec)
-spec.loader.exec_module(step3a_module)
-step3a_main = step3a_module.main
+pytestmark = pytest.mark.xdist_group("step3")
 
 
 class TestStep3aSendReply:
     """Test Step 3a's WhatsApp reply functionality"""
 
     @patch('requests.post')
-    def test_successful_message_send(self, mock_post):
+    def test_successful_message_send(self, mock_post, step3_1_main):
         """Test successful message sending"""
         # Mock successful API response
         mock_response = Mock()
@@ -45,7 +33,7 @@ class TestStep3aSendReply:
         mock_post.return_value = mock_response
 
         # Call function
-        result = step3a_main(
+        result = step3_1_main(
             phone_number_id="123456123",
             context_payload={
                 "proceed": True,
@@ -66,9 +54,9 @@ class TestStep3aSendReply:
         assert call_args[1]["headers"]["Authorization"] == "Bearer test_token"
         assert call_args[1]["json"]["text"]["body"] == "Hello! How can I help you?"
 
-    def test_no_text_to_send(self):
+    def test_no_text_to_send(self, step3_1_main):
         """Test handling when LLM result has no reply_text"""
-        result = step3a_main(
+        result = step3_1_main(
             phone_number_id="123456123",
             context_payload={
                 "proceed": True,
@@ -82,7 +70,7 @@ class TestStep3aSendReply:
         assert result["success"] is False
 
     @patch('requests.post')
-    def test_api_error_handling(self, mock_post):
+    def test_api_error_handling(self, mock_post, step3_1_main):
         """Test handling of WhatsApp API errors"""
         import requests
 
@@ -94,7 +82,7 @@ class TestStep3aSendReply:
         mock_response.raise_for_status.side_effect = requests.exceptions.HTTPError("API Error")
         mock_post.return_value = mock_response
 
-        result = step3a_main(
+        result = step3_1_main(
             phone_number_id="123456123",
             context_payload={
                 "proceed": True,
@@ -109,7 +97,7 @@ class TestStep3aSendReply:
         assert "error" in result
 
     @patch('requests.post')
-    def test_phone_number_formatting(self, mock_post):
+    def test_phone_number_formatting(self, mock_post, step3_1_main):
         """Test that phone numbers are formatted correctly"""
         mock_response = Mock()
         mock_response.ok = True
@@ -117,7 +105,7 @@ class TestStep3aSendReply:
         mock_post.return_value = mock_response
 
         # Test with + prefix (should be removed)
-        result = step3a_main(
+        result = step3_1_main(
             phone_number_id="123456123",
             context_payload={
                 "proceed": True,
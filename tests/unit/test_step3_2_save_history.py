@@ -10,40 +10,17 @@ Tests Step 3.2's ability to:
 """
 
 import pytest
-import sys
-import os
-from unittest.mock import Mock, patch, MagicMock
-
-# Add parent directories to path
-sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../../f/development'))
-
-# Mock wmill module before importing step4_
-mock_wmill = Mock()
-mock_wmill.get_resource.return_value = {
-    "host": "localhost",
-    "port": 5432,
-    "user": "test_user",
-    "password": "test_password",
-    "dbname": "test_db"
-}
-sys.modules['wmill'] = mock_wmill
-
-# Import the module under test
-import importlib.util
-spec = importlib.util.spec_from_file_location(
-    "step4_",
-    os.path.join(os.path.dirname(__file__), '../../f/development/4_save_chat_history.py')
-)
-step4_module = importlib.util.module_from_spec(spec)
-spec.loader.exec_module(step4_module)
-step4_main = step4_module.main
+from unittest.mock import patch, MagicMock
+
+
+pytestmark = pytest.mark.xdist_group("step3")
 
 
 class TestStep4_SaveHistory:
     """Test Step 3.2's chat history persistence functionality"""
 
     @patch('psycopg2.connect')
-    def test_successful_message_persistence(self, mock_connect):
+    def test_successful_message_persistence(self, mock_connect, step4_main):
         """Test successful saving of user and assistant messages"""
         # Setup mock database
         mock_conn = MagicMock()
@@ -86,7 +63,7 @@ class TestStep4_SaveHistory:
         assert mock_conn.commit.called
 
     @patch('psycopg2.connect')
-    def test_variable_update_persistence(self, mock_connect):
+    def test_variable_update_persistence(self, mock_connect, step4_main):
         """Test that LLM-extracted variables are persisted"""
         mock_conn = MagicMock()
         mock_cursor = MagicMock()
@@ -121,7 +98,7 @@ class TestStep4_SaveHistory:
         assert third_call[0][1][1] == "contact-123"
 
     @patch('psycopg2.connect')
-    def test_skip_when_step1_failed(self, mock_connect):
+    def test_skip_when_step1_failed(self, mock_connect, step4_main):
         """Test that history is not saved when Step 1 failed"""
         mock_conn = MagicMock()
         mock_cursor = MagicMock()
@@ -146,7 +123,7 @@ class TestStep4_SaveHistory:
         assert not mock_cursor.execute.called
 
     @patch('psycopg2.connect')
-    def test_skip_when_step2_failed(self, mock_connect):
+    def test_skip_when_step2_failed(self, mock_connect, step4_main):
         """Test that history is not saved when Step 2 (LLM) failed"""
         mock_conn = MagicMock()
         mock_cursor = MagicMock()
@@ -170,7 +147,7 @@ class TestStep4_SaveHistory:
         assert not mock_cursor.execute.called
 
     @patch('psycopg2.connect')
-    def test_skip_when_step3_failed(self, mock_connect):
+    def test_skip_when_step3_failed(self, mock_connect, step4_main):
         """Test that history is not saved when Step 3 (send to WhatsApp) failed"""
         mock_conn = MagicMock()
         mock_cursor = MagicMock()
@@ -196,7 +173,7 @@ class TestStep4_SaveHistory:
         assert not mock_cursor.execute.called
 
     @patch('psycopg2.connect')
-    def test_database_connection_error(self, mock_connect):
+    def test_database_connection_error(self, mock_connect, step4_main):
         """Test handling of database connection failures"""
         # Simulate connection failure
         mock_connect.side_effect = Exception("Connection refused")
@@ -215,7 +192,7 @@ class TestStep4_SaveHistory:
         assert "Connection refused" in result["error"]
 
     @patch('psycopg2.connect')
-    def test_database_insert_error(self, mock_connect):
+    def test_database_insert_error(self, mock_connect, step4_main):
         """Test handling of database insert failures"""
         mock_conn = MagicMock()
         mock_cursor = MagicMock()
@@ -239,7 +216,7 @@ class TestStep4_SaveHistory:
         assert "Foreign key constraint violation" in result["error"]
 
     @patch('psycopg2.connect')
-    def test_empty_reply_text_handling(self, mock_connect):
+    def test_empty_reply_text_handling(self, mock_connect, step4_main):
         """Test handling when LLM returns no reply text"""
         mock_conn = MagicMock()
         mock_cursor = MagicMock()
@@ -269,7 +246,7 @@ class TestStep4_SaveHistory:
         assert "'user'" in first_call[0][0]
 
     @patch('psycopg2.connect')
-    def test_no_variable_updates(self, mock_connect):
+    def test_no_variable_updates(self, mock_connect, step4_main):
         """Test that no UPDATE is executed when there are no variable updates"""
         mock_conn = MagicMock()
         mock_cursor = MagicMock()
@@ -295,7 +272,7 @@ class TestStep4_SaveHistory:
         assert mock_cursor.execute.call_count == 2
 
     @patch('psycopg2.connect')
-    def test_conversation_threading(self, mock_connect):
+    def test_conversation_threading(self, mock_connect, step4_main):
         """Test that messages maintain conversation threading via contact_id"""
         mock_conn = MagicMock()
         mock_cursor = MagicMock()
@@ -327,7 +304,7 @@ class TestStep4_SaveHistory:
         assert assistant_call[0][1][0] == contact_id
 
     @patch('psycopg2.connect')
-    def test_cleanup_on_error(self, mock_connect):
+    def test_cleanup_on_error(self, mock_connect, step4_main):
         """Test that database connections are properly closed on error"""
         mock_conn = MagicMock()
         mock_cursor = MagicMock()
@@ -11,41 +11,17 @@ Tests Step 3.3's ability to:
 """
 
 import pytest
-import sys
-import os
-from unittest.mock import Mock, patch, MagicMock
-
-# Add parent directories to path
-sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../../f/development'))
-
-# Mock wmill module before importing step5_
-mock_wmill = Mock()
-mock_wmill.get_resource.return_value = {
-    "host": "localhost",
-    "port": 5432,
-    "user": "test_user",
-    "password": "test_password",
-    "dbname": "test_db"
-}
-sys.modules['wmill'] = mock_wmill
-
-# Import the module under test
-import importlib.util
-spec = importlib.util.spec_from_file_location(
-    "step5_",
-    os.path.join(os.path.dirname(__file__), '../../f/development/5_log_usage.py')
-)
-step5_module = importlib.util.module_from_spec(spec)
-spec.loader.exec_module(step5_module)
-step5_main = step5_module.main
-_get_cost_per_1k_tokens = step5_module._get_cost_per_1k_tokens
+from unittest.mock import patch, MagicMock
+
+
+pytestmark = pytest.mark.xdist_group("step3")
 
 
 class TestStep5_UsageLogging:
     """Test Step 3.3's usage logging functionality"""
 
     @patch('psycopg2.connect')
-    def test_successful_usage_logging(self, mock_connect):
+    def test_successful_usage_logging(self, mock_connect, step5_main):
         """Test successful logging of usage data"""
         mock_conn = MagicMock()
         mock_cursor = MagicMock()
@@ -115,7 +91,7 @@ class TestStep5_UsageLogging:
         assert mock_conn.commit.called
 
     @patch('psycopg2.connect')
-    def test_token_estimation_fallback(self, mock_connect):
+    def test_token_estimation_fallback(self, mock_connect, step5_main):
         """Test token estimation when LLM doesn't provide usage info"""
         mock_conn = MagicMock()
         mock_cursor = MagicMock()
@@ -145,7 +121,7 @@ class TestStep5_UsageLogging:
         assert result["tokens_used"] > 0  # Should have estimated tokens
 
     @patch('psycopg2.connect')
-    def test_cost_calculation_openai(self, mock_connect):
+    def test_cost_calculation_openai(self, mock_connect, step5_main):
         """Test cost calculation for OpenAI models"""
         mock_conn = MagicMock()
         mock_cursor = MagicMock()
@@ -180,7 +156,7 @@ class TestStep5_UsageLogging:
         assert result["estimated_cost"] == pytest.approx(0.0075, rel=1e-6)
 
     @patch('psycopg2.connect')
-    def test_skip_when_step1_failed(self, mock_connect):
+    def test_skip_when_step1_failed(self, mock_connect, step5_main):
         """Test that usage is not logged when Step 1 failed"""
         mock_conn = MagicMock()
         mock_cursor = MagicMock()
@@ -201,7 +177,7 @@ class TestStep5_UsageLogging:
         assert not mock_cursor.execute.called
 
     @patch('psycopg2.connect')
-    def test_skip_when_step2_failed(self, mock_connect):
+    def test_skip_when_step2_failed(self, mock_connect, step5_main):
         """Test that usage is not logged when Step 2 (LLM) failed"""
         mock_conn = MagicMock()
         mock_cursor = MagicMock()
@@ -225,7 +201,7 @@ class TestStep5_UsageLogging:
         assert not mock_cursor.execute.called
 
     @patch('psycopg2.connect')
-    def test_skip_when_step3_failed(self, mock_connect):
+    def test_skip_when_step3_failed(self, mock_connect, step5_main):
         """Test that usage is not logged when Step 3 (send to WhatsApp) failed"""
         mock_conn = MagicMock()
         mock_cursor = MagicMock()
@@ -251,7 +227,7 @@ class TestStep5_UsageLogging:
         assert not mock_cursor.execute.called
 
     @patch('psycopg2.connect')
-    def test_database_error_cleanup(self, mock_connect):
+    def test_database_error_cleanup(self, mock_connect, step5_main):
         """Test that database errors trigger proper cleanup (close)"""
         mock_conn = MagicMock()
         mock_cursor = MagicMock()
@@ -279,7 +255,7 @@ class TestStep5_UsageLogging:
         assert mock_conn.close.called
 
     @patch('psycopg2.connect')
-    def test_usage_summary_upsert(self, mock_connect):
+    def test_usage_summary_upsert(self, mock_connect, step5_main):
         """Test that usage_summary is updated via UPSERT pattern"""
         mock_conn = MagicMock()
         mock_cursor = MagicMock()
@@ -315,31 +291,31 @@ class TestStep5_UsageLogging:
         assert "current_period_messages =" in update_call[0][0]
         assert "current_period_tokens =" in update_call[0][0]
 
-    def test_cost_calculation_for_different_providers(self):
+    def test_cost_calculation_for_different_providers(self, step5_module):
         """Test cost calculation helper for various providers/models"""
         # OpenAI GPT-4o
-        cost = _get_cost_per_1k_tokens("openai", "gpt-4o")
+        cost = step5_module._get_cost_per_1k_tokens("openai", "gpt-4o")
         assert cost == 0.005
 
         # OpenAI GPT-4o-mini - Now correctly matches specific model first
         # (pricing dict is ordered from most specific to least specific)
-        cost = _get_cost_per_1k_tokens("openai", "gpt-4o-mini")
+        cost = step5_module._get_cost_per_1k_tokens("openai", "gpt-4o-mini")
         assert cost == 0.0002  # Correctly matches "gpt-4o-mini" first
 
         # Google Gemini Flash
-        cost = _get_cost_per_1k_tokens("google", "gemini-3-flash-preview")
+        cost = step5_module._get_cost_per_1k_tokens("google", "gemini-3-flash-preview")
         assert cost == 0.00025
 
         # Anthropic Claude Sonnet
-        cost = _get_cost_per_1k_tokens("anthropic", "claude-3-sonnet")
+        cost = step5_module._get_cost_per_1k_tokens("anthropic", "claude-3-sonnet")
         assert cost == 0.003
 
         # Unknown provider - should return fallback
-        cost = _get_cost_per_1k_tokens("unknown", "unknown-model")
+        cost = step5_module._get_cost_per_1k_tokens("unknown", "unknown-model")
         assert cost == 0.001  # Fallback rate
 
     @patch('psycopg2.connect')
-    def test_webhook_event_id_tracking(self, mock_connect):
+    def test_webhook_event_id_tracking(self, mock_connect, step5_main):
         """Test that webhook_event_id is properly tracked"""
         mock_conn = MagicMock()
         mock_cursor = MagicMock()
@@ -367,7 +343,7 @@ class TestStep5_UsageLogging:
         assert webhook_id in insert_call[0][1]
 
     @patch('psycopg2.connect')
-    def test_cleanup_on_error(self, mock_connect):
+    def test_cleanup_on_error(self, mock_connect, step5_main):
         """Test that database connections are properly closed on error"""
         mock_conn = MagicMock()
         mock_cursor = MagicMock()
@@ -394,7 +370,7 @@ class TestStep5_UsageLogging:
         assert mock_conn.close.called
 
     @patch('psycopg2.connect')
-    def test_returns_tokens_even_on_logging_failure(self, mock_connect):
+    def test_returns_tokens_even_on_logging_failure(self, mock_connect, step5_main):
         """Test that token count is still returned even if logging fails"""
         mock_conn = MagicMock()
         mock_cursor = MagicMock()
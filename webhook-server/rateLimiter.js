@@ -94,7 +94,10 @@ export async function checkRateLimit(phoneNumberId, planTier = 'free') {
     const currentCount = results[1];
 
     if (currentCount >= maxRequests) {
-      // Rate limit exceeded
+      // Rate limit exceeded - drop the entry we just added so rejected
+      // requests don't keep pushing the window forward
+      await redisClient.zRem(key, now.toString());
+
       // Get the oldest request to calculate reset time
       const oldestRequest = await redisClient.zRange(key, 0, 0, { REV: false });
       const resetIn = oldestRequest.length > 0